@@ -0,0 +1,122 @@
+#!/bin/pypy3
+"""
+Analyse a file of FEN or EPD positions, one per line, and write one JSON
+line per position in input order. Positions are searched by a pool of
+worker processes that stay up for the whole file, and only a bounded number
+of them is read ahead of the output.
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Iterator, Optional, Tuple
+
+import chessy
+import uci
+
+# Positions handed out per worker before the oldest result is waited for
+PENDING_PER_JOB = 4
+
+# line, default depth, default movetime in milliseconds
+task_t = Tuple[str, int, Optional[int]]
+
+
+def parse_line(line: str) -> Tuple[str, Dict[str, str]]:
+    """
+    FEN and EPD operations of a line. EPD lines have four FEN fields
+    followed by operations like bm Nf3; id "name";
+    """
+    fields = line.split()
+    if len(fields) >= 6 and fields[4].isdigit() and fields[5].isdigit():
+        return " ".join(fields[:6]), {}
+    operations = {}
+    for operation in " ".join(fields[4:]).split(";"):
+        opcode, _, operand = operation.strip().partition(" ")
+        if opcode:
+            operations[opcode] = operand.strip().strip('"')
+    return " ".join(fields[:4]) + " 0 1", operations
+
+
+def analyse(task: task_t) -> Dict:
+    """
+    Search one position. The EPD operations acd and acs, analysis depth and
+    seconds, override the default limits.
+    """
+    line, depth, movetime = task
+    fen, operations = parse_line(line)
+    result: Dict = {"fen": fen}
+    if "id" in operations:
+        result["id"] = operations["id"]
+    # parse_FEN raises plain Exceptions for bad input
+    try:
+        state = chessy.parse_FEN(fen)
+        if "acd" in operations:
+            depth = int(operations["acd"])
+        if "acs" in operations:
+            movetime = int(float(operations["acs"]) * 1000)
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+    # The move generation needs both kings on the board
+    if chessy.OFF_THE_BOARD in state.kings:
+        result["error"] = "a king is missing"
+        return result
+
+    # Every position starts from an empty table so results do not depend on
+    # which worker searched what before
+    chessy.transposition_table.clear()
+    best: Dict = {}
+    def report(depth: int, score: int, move: chessy.move_t) -> None:
+        best.update(depth=depth, score=score, move=move)
+
+    start = time.time()
+    chessy.iterative_deepening(state, depth, movetime=movetime, report=report)
+    result["time"] = round(time.time() - start, 3)
+    result["nodes"] = chessy.nodes
+    if not best:
+        result["bestmove"] = None
+        return result
+    result["bestmove"] = chessy.move_to_uci(best["move"])
+    result["depth"] = best["depth"]
+    kind, value = uci.score_string(best["score"], best["depth"]).split()
+    result[kind] = int(value)
+    return result
+
+
+def analyse_lines(lines: Iterable[str], depth: int, movetime: Optional[int] = None,
+                  jobs: int = 1) -> Iterator[Dict]:
+    """Results of the positions in lines, in order, blank and # lines skipped"""
+    tasks = ((line, depth, movetime) for line in lines
+             if line.strip() and not line.startswith("#"))
+    if jobs <= 1:
+        yield from map(analyse, tasks)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        pending: Deque = deque()
+        for task in tasks:
+            if len(pending) >= jobs * PENDING_PER_JOB:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(analyse, (task,)))
+        while pending:
+            yield pending.popleft().get()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Search every FEN or EPD position of a file and write JSON lines")
+    parser.add_argument("file", nargs="?", default="-",
+                        help="positions one per line, - for stdin")
+    parser.add_argument("--depth", type=int, default=4,
+                        help="search depth, unless the EPD acd operation sets it")
+    parser.add_argument("--movetime", type=int,
+                        help="milliseconds per position, unless the EPD acs operation sets it")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes")
+    args = parser.parse_args()
+
+    lines = sys.stdin if args.file == "-" else open(args.file)
+    with lines:
+        for result in analyse_lines(lines, args.depth, args.movetime, args.jobs):
+            print(json.dumps(result), flush=True)
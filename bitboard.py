@@ -0,0 +1,365 @@
+#!/bin/pypy3
+"""
+Bitboard position backend for chessy.
+
+Positions are kept as 64-bit integers, one bit per square, so attacks and
+move targets for a whole piece are computed with a few integer operations
+instead of walking the 0x88 board square by square. Squares are numbered
+a8 = 0 to h1 = 63 in the same order as chessy's 0x88 board, and the FEN,
+move_generation and UCI move functions match chessy's, so results can be
+checked against each other and against test.json.
+"""
+from typing import NamedTuple, Tuple, List, Dict, Iterator, Optional
+
+import chessy
+from chessy import (w, b, P, R, N, B, Q, K, PLAYER_BITS,
+                    wOO, wOOO, bOO, bOOO, wc, bc, OFF_THE_BOARD)
+
+# Board coordinates for reference
+# 0,   1,  2,  3,  4,  5,  6,  7,    a8 ... h8
+# 8,   9, 10, 11, 12, 13, 14, 15,
+# ...
+# 56, 57, 58, 59, 60, 61, 62, 63,    a1 ... h1
+
+FULL = 0xFFFF_FFFF_FFFF_FFFF
+SQUARE_BB = tuple(1 << sq for sq in range(64))
+SQ88 = tuple((sq >> 3) << 4 | (sq & 7) for sq in range(64))
+SQ64 = {sq88: sq for sq, sq88 in enumerate(SQ88)}
+
+# Indexes into BitboardState.bitboards
+BITBOARDS = [WHITE, BLACK, PAWNS, ROOKS, KNIGHTS, BISHOPS, QUEENS, KINGS] = range(8)
+PIECE_BITBOARD = {P: PAWNS, R: ROOKS, N: KNIGHTS, B: BISHOPS, Q: QUEENS, K: KINGS}
+BITBOARD_PIECE = {v: k for k, v in PIECE_BITBOARD.items()}
+COLOUR_BITBOARD = {w: WHITE, b: BLACK}
+
+MOVE_KINDS = [NORMAL, DOUBLE_PUSH, EN_PASSANT, CASTLE] = range(4)
+
+ROOK_DELTAS = ((-1, 0), (0, 1), (1, 0), (0, -1))
+BISHOP_DELTAS = ((-1, -1), (-1, 1), (1, -1), (1, 1))
+KNIGHT_DELTAS = ((-2, 1), (-2, -1), (-1, 2), (-1, -2),
+                 (2, 1), (2, -1), (1, 2), (1, -2))
+KING_DELTAS = ROOK_DELTAS + BISHOP_DELTAS
+
+
+def _on_board(row: int, col: int) -> bool:
+    return 0 <= row < 8 and 0 <= col < 8
+
+
+def _step_attacks(sq: int, deltas) -> int:
+    row, col = divmod(sq, 8)
+    return sum(SQUARE_BB[(row + dr) * 8 + col + dc]
+               for dr, dc in deltas if _on_board(row + dr, col + dc))
+
+
+def _ray(sq: int, dr: int, dc: int) -> List[int]:
+    row, col = divmod(sq, 8)
+    squares = []
+    row, col = row + dr, col + dc
+    while _on_board(row, col):
+        squares.append(row * 8 + col)
+        row, col = row + dr, col + dc
+    return squares
+
+
+def _slider_attacks(sq: int, occupied: int, deltas) -> int:
+    attacks = 0
+    for dr, dc in deltas:
+        for s in _ray(sq, dr, dc):
+            attacks |= SQUARE_BB[s]
+            if occupied & SQUARE_BB[s]: break
+    return attacks
+
+
+def _slider_tables(deltas) -> Tuple[Tuple[int, ...], Tuple[Dict[int, int], ...]]:
+    """
+    Attack sets for every blocker configuration of every square. Where C
+    engines hash the relevant occupancy with a magic multiplication, a dict
+    keyed by the masked occupancy itself is the cheapest perfect hash in Python.
+    """
+    masks = []
+    tables = []
+    for sq in range(64):
+        # The last square of a ray never changes the attack set
+        mask = sum(SQUARE_BB[s] for dr, dc in deltas for s in _ray(sq, dr, dc)[:-1])
+        table = {}
+        subset = 0
+        while True:
+            table[subset] = _slider_attacks(sq, subset, deltas)
+            subset = (subset - mask) & mask
+            if not subset: break
+        masks.append(mask)
+        tables.append(table)
+    return tuple(masks), tuple(tables)
+
+
+KNIGHT_ATTACKS = tuple(_step_attacks(sq, KNIGHT_DELTAS) for sq in range(64))
+KING_ATTACKS = tuple(_step_attacks(sq, KING_DELTAS) for sq in range(64))
+PAWN_ATTACKS = {w: tuple(_step_attacks(sq, ((-1, -1), (-1, 1))) for sq in range(64)),
+                b: tuple(_step_attacks(sq, ((1, -1), (1, 1))) for sq in range(64))}
+ROOK_MASKS, ROOK_TABLES = _slider_tables(ROOK_DELTAS)
+BISHOP_MASKS, BISHOP_TABLES = _slider_tables(BISHOP_DELTAS)
+
+
+def _between(a: int, c: int) -> int:
+    for dr, dc in KING_DELTAS:
+        ray = _ray(a, dr, dc)
+        if c in ray:
+            return sum(SQUARE_BB[s] for s in ray[:ray.index(c)])
+    return 0
+
+
+def _line(a: int, c: int) -> int:
+    for dr, dc in KING_DELTAS:
+        if c in _ray(a, dr, dc):
+            return (SQUARE_BB[a] | sum(SQUARE_BB[s] for s in _ray(a, dr, dc))
+                    | sum(SQUARE_BB[s] for s in _ray(a, -dr, -dc)))
+    return 0
+
+
+# Squares strictly between two squares on a line, and the whole line through them
+BETWEEN = tuple(tuple(_between(a, c) for c in range(64)) for a in range(64))
+LINE = tuple(tuple(_line(a, c) for c in range(64)) for a in range(64))
+
+# Castling rights kept when a piece moves from or to a square
+CASTLE_KEPT = [wc | bc] * 64
+CASTLE_KEPT[SQ64[116]] &= ~wc
+CASTLE_KEPT[SQ64[119]] &= ~wOO
+CASTLE_KEPT[SQ64[112]] &= ~wOOO
+CASTLE_KEPT[SQ64[4]] &= ~bc
+CASTLE_KEPT[SQ64[7]] &= ~bOO
+CASTLE_KEPT[SQ64[0]] &= ~bOOO
+
+# castle right: king from, king to, rook from, rook to, must be empty, must not be attacked
+CASTLING = {
+    wOO:  (60, 62, 63, 61, SQUARE_BB[61] | SQUARE_BB[62], (61, 62)),
+    wOOO: (60, 58, 56, 59, SQUARE_BB[57] | SQUARE_BB[58] | SQUARE_BB[59], (59, 58)),
+    bOO:  (4, 6, 7, 5, SQUARE_BB[5] | SQUARE_BB[6], (5, 6)),
+    bOOO: (4, 2, 0, 3, SQUARE_BB[1] | SQUARE_BB[2] | SQUARE_BB[3], (3, 2)),
+}
+PROMOTION_ROWS = SQUARE_BB[0] * 0xFF | SQUARE_BB[56] * 0xFF
+
+# from_square, to_square, pawn_promote, kind
+move_t = Tuple[int, int, int, int]
+class BitboardState(NamedTuple):
+    bitboards: Tuple[int, ...]
+    player: int
+    castle: int
+    ep: int
+    pawnmove: int
+    num_moves: int
+
+
+def lsb(bb: int) -> int:
+    return (bb & -bb).bit_length() - 1
+
+
+def squares(bb: int) -> Iterator[int]:
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def rook_attacks(sq: int, occupied: int) -> int:
+    return ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+
+
+def bishop_attacks(sq: int, occupied: int) -> int:
+    return BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+
+
+def attackers(bitboards: Tuple[int, ...], sq: int, occupied: int, by_player: int) -> int:
+    """Pieces of by_player attacking sq with the given occupancy"""
+    them = bitboards[COLOUR_BITBOARD[by_player]]
+    queens = bitboards[QUEENS]
+    return them & (
+        (KNIGHT_ATTACKS[sq] & bitboards[KNIGHTS])
+        | (KING_ATTACKS[sq] & bitboards[KINGS])
+        | (PAWN_ATTACKS[by_player ^ PLAYER_BITS][sq] & bitboards[PAWNS])
+        | (rook_attacks(sq, occupied) & (bitboards[ROOKS] | queens))
+        | (bishop_attacks(sq, occupied) & (bitboards[BISHOPS] | queens)))
+
+
+def from_gamestate(state: chessy.GameState) -> BitboardState:
+    bitboards = [0] * 8
+    for sq, sq88 in enumerate(SQ88):
+        piece = state.board[sq88]
+        if piece:
+            bitboards[COLOUR_BITBOARD[piece & PLAYER_BITS]] |= SQUARE_BB[sq]
+            bitboards[PIECE_BITBOARD[piece & ~PLAYER_BITS]] |= SQUARE_BB[sq]
+    ep = SQ64.get(state.ep, OFF_THE_BOARD)
+    return BitboardState(tuple(bitboards), state.player, state.castle,
+                         ep, state.pawnmove, state.num_moves)
+
+
+def to_gamestate(state: BitboardState) -> chessy.GameState:
+    board = [0] * OFF_THE_BOARD
+    for colour in (w, b):
+        for bb_index, piece in BITBOARD_PIECE.items():
+            for sq in squares(state.bitboards[COLOUR_BITBOARD[colour]] & state.bitboards[bb_index]):
+                board[SQ88[sq]] = piece | colour
+    ep = SQ88[state.ep] if state.ep != OFF_THE_BOARD else OFF_THE_BOARD
+    return chessy.game_state(board, state.player, state.castle,
+                             ep, state.pawnmove, state.num_moves)
+
+
+def parse_FEN(fen_string: str) -> BitboardState:
+    return from_gamestate(chessy.parse_FEN(fen_string))
+
+
+def to_fen(state: BitboardState) -> str:
+    return chessy.to_fen(to_gamestate(state))
+
+
+def move_to_uci(move: move_t) -> str:
+    from_square, to_square, pawn_promote, _ = move
+    return (chessy.BOARD_NOTATION[SQ88[from_square]] + chessy.BOARD_NOTATION[SQ88[to_square]]
+            + (chessy.PROMOTE_PIECE_ENCODING[pawn_promote] if pawn_promote else ""))
+
+
+def uci_to_move(state: BitboardState, move: str) -> Optional[move_t]:
+    """The legal move written as move, None if there is none"""
+    for m in legal_moves(state):
+        if move_to_uci(m) == move.lower():
+            return m
+    return None
+
+
+def move_generation(state: BitboardState) -> Dict[move_t, BitboardState]:
+    return {m: make_move(state, m) for m in legal_moves(state)}
+
+
+def legal_moves(state: BitboardState) -> List[move_t]:
+    bitboards = state.bitboards
+    player = state.player
+    other_player = player ^ PLAYER_BITS
+    own = bitboards[COLOUR_BITBOARD[player]]
+    them = bitboards[COLOUR_BITBOARD[other_player]]
+    occupied = own | them
+    king = lsb(bitboards[KINGS] & own)
+    moves: List[move_t] = []
+
+    # KING MOVES, checked with the king lifted off the board so it cannot
+    # hide behind itself from a slider
+    without_king = occupied ^ SQUARE_BB[king]
+    for to in squares(KING_ATTACKS[king] & ~own):
+        if not attackers(bitboards, to, without_king, other_player):
+            moves.append((king, to, 0, NORMAL))
+
+    checkers = attackers(bitboards, king, occupied, other_player)
+    if checkers & (checkers - 1):
+        # DOUBLE CHECK ONLY KING MOVES
+        return moves
+    if checkers:
+        targets = BETWEEN[king][lsb(checkers)] | checkers
+    else:
+        targets = FULL
+        for right, (_, king_to, _, _, empty, safe) in CASTLING.items():
+            if state.castle & right and not occupied & empty and not any(
+                    attackers(bitboards, sq, occupied, other_player) for sq in safe):
+                moves.append((king, king_to, 0, CASTLE))
+
+    # PINS, a pinned piece may only move along the line to its pinner
+    pin_lines: Dict[int, int] = {}
+    queens = bitboards[QUEENS]
+    snipers = them & (
+        (rook_attacks(king, them) & (bitboards[ROOKS] | queens))
+        | (bishop_attacks(king, them) & (bitboards[BISHOPS] | queens)))
+    for sniper in squares(snipers):
+        blockers = BETWEEN[king][sniper] & occupied
+        if blockers & own and not blockers & (blockers - 1):
+            pin_lines[lsb(blockers)] = LINE[king][sniper]
+
+    # The slider tables are looked up inline and the destinations popped in 
+    # place, this loop makes most of the moves
+    allowed_to = ~own & targets
+    for piece in (KNIGHTS, BISHOPS, ROOKS, QUEENS):
+        for sq in squares(bitboards[piece] & own):
+            if piece == KNIGHTS:
+                if sq in pin_lines: continue
+                destinations = KNIGHT_ATTACKS[sq]
+            elif piece == BISHOPS:
+                destinations = BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+            elif piece == ROOKS:
+                destinations = ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+            else:
+                destinations = (ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+                                | BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]])
+            destinations &= allowed_to
+            if sq in pin_lines:
+                destinations &= pin_lines[sq]
+            while destinations:
+                low = destinations & -destinations
+                moves.append((sq, low.bit_length() - 1, 0, NORMAL))
+                destinations ^= low
+
+    # PAWN RULES
+    forward = -8 if player & w else 8
+    start_rows = 0xFF << 48 if player & w else 0xFF << 8
+    for sq in squares(bitboards[PAWNS] & own):
+        allowed = targets & pin_lines.get(sq, FULL)
+        to = sq + forward
+        if not occupied & SQUARE_BB[to]:
+            if allowed & SQUARE_BB[to]:
+                if SQUARE_BB[to] & PROMOTION_ROWS:
+                    moves.extend((sq, to, promote_to, NORMAL) for promote_to in (Q, R, B, N))
+                else:
+                    moves.append((sq, to, 0, NORMAL))
+            double_move = to + forward
+            if SQUARE_BB[sq] & start_rows and allowed & SQUARE_BB[double_move] and not (
+                    occupied & SQUARE_BB[double_move]):
+                moves.append((sq, double_move, 0, DOUBLE_PUSH))
+        for to in squares(PAWN_ATTACKS[player][sq] & them & allowed):
+            if SQUARE_BB[to] & PROMOTION_ROWS:
+                moves.extend((sq, to, promote_to, NORMAL) for promote_to in (Q, R, B, N))
+            else:
+                moves.append((sq, to, 0, NORMAL))
+        if state.ep != OFF_THE_BOARD and PAWN_ATTACKS[player][sq] & SQUARE_BB[state.ep]:
+            # ENPASSANT CAPTURE, checked by playing it on the occupancy since
+            # two pawns leave the same rank at once
+            captured = state.ep - forward
+            after = occupied ^ SQUARE_BB[sq] ^ SQUARE_BB[captured] | SQUARE_BB[state.ep]
+            remaining = [*bitboards]
+            remaining[PAWNS] ^= SQUARE_BB[captured]
+            remaining[COLOUR_BITBOARD[other_player]] ^= SQUARE_BB[captured]
+            if not attackers(tuple(remaining), king, after, other_player):
+                moves.append((sq, state.ep, 0, EN_PASSANT))
+    return moves
+
+
+def make_move(state: BitboardState, move: move_t) -> BitboardState:
+    from_square, to_square, pawn_promote, kind = move
+    bitboards = [*state.bitboards]
+    player = state.player
+    own, them = COLOUR_BITBOARD[player], COLOUR_BITBOARD[player ^ PLAYER_BITS]
+    from_bb, to_bb = SQUARE_BB[from_square], SQUARE_BB[to_square]
+    moved = next(i for i in range(PAWNS, KINGS + 1) if bitboards[i] & from_bb)
+
+    capture = bitboards[them] & to_bb
+    if capture:
+        for i in range(PAWNS, KINGS + 1):
+            bitboards[i] &= ~to_bb
+        bitboards[them] ^= to_bb
+    bitboards[own] ^= from_bb | to_bb
+    bitboards[moved] ^= from_bb
+    bitboards[PIECE_BITBOARD[pawn_promote] if pawn_promote else moved] |= to_bb
+
+    ep = OFF_THE_BOARD
+    if kind == DOUBLE_PUSH:
+        ep = (from_square + to_square) >> 1
+    elif kind == EN_PASSANT:
+        captured = SQUARE_BB[to_square + (8 if player & w else -8)]
+        bitboards[PAWNS] ^= captured
+        bitboards[them] ^= captured
+        capture = captured
+    elif kind == CASTLE:
+        for _, king_to, rook_from, rook_to, _, _ in CASTLING.values():
+            if king_to == to_square:
+                rook_move = SQUARE_BB[rook_from] | SQUARE_BB[rook_to]
+                bitboards[ROOKS] ^= rook_move
+                bitboards[own] ^= rook_move
+
+    pawnmove = 0 if moved == PAWNS or capture else state.pawnmove + 1
+    return BitboardState(tuple(bitboards), player ^ PLAYER_BITS,
+        state.castle & CASTLE_KEPT[from_square] & CASTLE_KEPT[to_square],
+        ep, pawnmove, state.num_moves + (1 if player & b else 0))
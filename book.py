@@ -0,0 +1,209 @@
+#!/bin/pypy3
+"""
+Opening book in the Polyglot file layout: 16 byte big endian records of
+key, move, weight and learn, sorted by key. Keys are chessy's own zobrist
+hashes (see book_key) rather than Polyglot's, so books are built from PGN with this module.
+"""
+import argparse
+import mmap
+import os
+import random
+import re
+import struct
+from collections import Counter
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import chessy
+
+RECORD = struct.Struct(">QHHI")
+MAX_WEIGHT = 0xffff
+BOOK_PLIES = 20
+# Polyglot promotion piece numbers
+PROMOTE_NUMBER = {chessy.N: 1, chessy.B: 2, chessy.R: 3, chessy.Q: 4}
+NUMBER_PROMOTE = {number: piece for piece, number in PROMOTE_NUMBER.items()}
+
+SAN_PIECE = {"N": chessy.N, "B": chessy.B, "R": chessy.R, "Q": chessy.Q, "K": chessy.K}
+SAN_MOVE = re.compile(r"([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?")
+# Comments, variations (removed innermost first), and NAGs, move numbers and results
+PGN_COMMENT = re.compile(r"\{[^}]*\}|;[^\n]*")
+PGN_VARIATION = re.compile(r"\([^()]*\)")
+PGN_NOISE = re.compile(r"\$\d+|\d+\.+|1-0|0-1|1/2-1/2|\*")
+
+
+def book_key(state: chessy.GameState) -> int:
+    """
+    zobrist of state, counting the en passant square only if an en passant 
+    capture is legal like Polyglot does, so FENs that leave it out agree
+    """
+    if state.ep == chessy.OFF_THE_BOARD or any(
+            m & chessy.EP_FLAG for m in chessy.legal_moves(state)):
+        return state.zobrist
+    return state.zobrist ^ chessy.ZOBRIST_EP[state.ep] ^ chessy.ZOBRIST_EP[chessy.OFF_THE_BOARD]
+
+
+def square_index(square: int) -> int:
+    """0x88 square as a Polyglot square, a1 = 0 to h8 = 63"""
+    return (7 - (square >> 4)) * 8 + (square & 7)
+
+
+def encode_book_move(move: chessy.move_t) -> int:
+    from_square, to_square = move & 0x7f, move >> 7 & 0x7f
+    promote = move >> chessy.PROMOTE_SHIFT & 0x3f
+    return (square_index(to_square) | square_index(from_square) << 6
+            | PROMOTE_NUMBER.get(promote, 0) << 12)
+
+
+def decode_book_move(state: chessy.GameState, book_move: int) -> Optional[chessy.move_t]:
+    """The legal move of state written as book_move, None if there is none"""
+    to_square, from_square = book_move & 0x3f, book_move >> 6 & 0x3f
+    uci = chessy.BOARD_NOTATION[(7 - (from_square >> 3)) * 16 + (from_square & 7)] \
+        + chessy.BOARD_NOTATION[(7 - (to_square >> 3)) * 16 + (to_square & 7)]
+    promote = NUMBER_PROMOTE.get(book_move >> 12 & 0x7)
+    if promote:
+        uci += chessy.PROMOTE_PIECE_ENCODING[promote]
+    return chessy.uci_to_move(state, uci)
+
+
+class OpeningBook:
+    """A book file mapped into memory, probed by binary search on the key"""
+    def __init__(self, path: str) -> None:
+        self.data: Union[mmap.mmap, bytes] = b""
+        with open(path, "rb") as f:
+            # mmap refuses empty files
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.num_records = len(self.data) // RECORD.size
+
+    def close(self) -> None:
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def records(self, key: int) -> Iterator[Tuple[int, int]]:
+        """Move and weight of every record with key"""
+        lo, hi = 0, self.num_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if RECORD.unpack_from(self.data, mid * RECORD.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo, self.num_records):
+            record_key, move, weight, _ = RECORD.unpack_from(self.data, i * RECORD.size)
+            if record_key != key: break
+            yield move, weight
+
+    def probe(self, state: chessy.GameState) -> List[Tuple[chessy.move_t, int]]:
+        """Legal book moves of state and their weights, heaviest first"""
+        moves = []
+        for book_move, weight in self.records(book_key(state)):
+            move = decode_book_move(state, book_move)
+            if move is not None and weight:
+                moves.append((move, weight))
+        return sorted(moves, key=lambda m: m[1], reverse=True)
+
+    def choose(self, state: chessy.GameState,
+               rng: Optional[random.Random] = None) -> Optional[chessy.move_t]:
+        """
+        A book move picked at random in proportion to its weight, with rng or
+        the random module
+        """
+        moves = self.probe(state)
+        if not moves:
+            return None
+        return (rng or random).choices([m for m, _ in moves], [w for _, w in moves])[0]
+
+
+def san_to_move(state: chessy.GameState, san: str) -> Optional[chessy.move_t]:
+    """The legal move written as san in standard algebraic notation"""
+    san = san.rstrip("+#!?")
+    moves = chessy.legal_moves(state)
+    if san in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        file = "g" if len(san) == 3 else "c"
+        for m in moves:
+            if m & chessy.CASTLE_FLAG and chessy.move_to_uci(m)[2] == file:
+                return m
+        return None
+    match = SAN_MOVE.fullmatch(san)
+    if match is None:
+        return None
+    piece, from_file, from_rank, to_square, promote = match.groups()
+    piece_type = SAN_PIECE[piece] if piece else chessy.P
+    promote_piece = chessy.PROMOTE_PIECE[promote] if promote else 0
+    found = None
+    for m in moves:
+        uci = chessy.move_to_uci(m)
+        if (uci[2:4] == to_square and state.board[m & 0x7f] & piece_type
+                and (from_file is None or uci[0] == from_file)
+                and (from_rank is None or uci[1] == from_rank)
+                and m >> chessy.PROMOTE_SHIFT & 0x3f == promote_piece):
+            if found is not None:
+                return None
+            found = m
+    return found
+
+
+def pgn_games(lines: Iterable[str]) -> Iterator[Tuple[str, List[str]]]:
+    """Starting FEN and SAN moves of every game in the lines of a PGN file"""
+    fen = chessy.STARTING_FEN
+    movetext: List[str] = []
+    for line in chain(lines, ["[End]"]):
+        if line.startswith("["):
+            if movetext:
+                yield fen, parse_movetext("\n".join(movetext))
+                fen, movetext = chessy.STARTING_FEN, []
+            tag = re.match(r'\[FEN "([^"]*)"\]', line)
+            if tag:
+                fen = tag.group(1)
+        elif line.strip() and not line.startswith("%"):
+            movetext.append(line)
+
+
+def parse_movetext(movetext: str) -> List[str]:
+    movetext = PGN_COMMENT.sub(" ", movetext)
+    while True:
+        movetext, removed = PGN_VARIATION.subn(" ", movetext)
+        if not removed: break
+    return PGN_NOISE.sub(" ", movetext).split()
+
+
+def build_book(pgn_lines: Iterable[str], plies: int = BOOK_PLIES) -> bytes:
+    """Book records of the first plies of every game, weighted by games played"""
+    counts: Dict[Tuple[int, int], int] = Counter()
+    for fen, sans in pgn_games(pgn_lines):
+        state = chessy.parse_FEN(fen)
+        for san in sans[:plies]:
+            move = san_to_move(state, san)
+            if move is None: break
+            counts[book_key(state), encode_book_move(move)] += 1
+            state = chessy.generate_new_state(state, *chessy.decode_move(move))
+    records = sorted(counts.items(), key=lambda r: (r[0][0], -r[1]))
+    return b"".join(RECORD.pack(key, move, min(weight, MAX_WEIGHT), 0)
+                    for (key, move), weight in records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or probe an opening book")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build a book from a PGN file")
+    build.add_argument("pgn")
+    build.add_argument("book")
+    build.add_argument("--plies", type=int, default=BOOK_PLIES,
+                       help="half moves of each game to put in the book")
+    probe = commands.add_parser("probe", help="list the book moves of a position")
+    probe.add_argument("book")
+    probe.add_argument("fen", nargs="?", default=chessy.STARTING_FEN)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        with open(args.pgn, encoding="utf-8", errors="replace") as pgn:
+            data = build_book(pgn, args.plies)
+        with open(args.book, "wb") as out:
+            out.write(data)
+        print(f"{len(data) // RECORD.size} positions and moves")
+    else:
+        book = OpeningBook(args.book)
+        state = chessy.parse_FEN(args.fen)
+        for move, weight in book.probe(state):
+            print(f"{chessy.move_to_uci(move)} {weight}")
+        book.close()
@@ -2,9 +2,20 @@
 """
 A silly chessengine.
 """
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.synchronize
 import re
 import random
-from typing import NamedTuple, Tuple, List, Dict, Set
+import struct
+import time
+from array import array
+from collections import Counter
+from multiprocessing.sharedctypes import Synchronized
+from typing import NamedTuple, Tuple, List, Dict, Mapping, Set, Iterator, Optional, Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import tablebase
 
 # Board coordinates for reference
 # 0,     1,  2,    3,  4,    5,   6,   7,	
@@ -33,6 +44,10 @@ PIECES = [wP, wR, wN, wB, wQ, wK,
 FLAGS = [attacked_square, attacked_piece, unsafe_square,
          pinned_piece, enpasant_square] = [0b0001, 0b0010, 0b0100, 0b01000, 0b10000]
 
+# Captures and promotions are generated before quiet moves
+MOVE_STAGES = [CAPTURE_MOVES, QUIET_MOVES] = [0b01, 0b10]
+ALL_MOVES = CAPTURE_MOVES | QUIET_MOVES
+
 PIECE_NOTATION = {"p": bP, "r": bR, "n": bN, "b": bB, "q": bQ, "k": bK,
                   "P": wP, "R": wR, "N": wN, "B": wB, "Q": wQ, "K": wK}
 PIECE_ENCODING = {bP: "p", bR: "r", bN: "n", bB: "b", bQ: "q", bK: "k",
@@ -77,6 +92,38 @@ MOVE_VECTORS = {
     wK: [north+west, north+east, south+west, south+east, north, east, south, west],}
 
 
+def _ray(square: int, direction: int) -> Tuple[int, ...]:
+    ray = []
+    square += direction
+    while not square & 0x88:
+        ray.append(square)
+        square += direction
+    return tuple(ray)
+
+
+def _neighbours(square: int, vectors: List[int]) -> Tuple[int, ...]:
+    return tuple(square + m for m in vectors if 0 <= square + m < 128 and not (square + m) & 0x88)
+
+
+# Attack tables per square, off the board entries are empty.
+# RAYS holds the squares along each line from a square, nearest first, with
+# the slider pieces attacking along it. The squares between a square and a
+# piece on one of its lines are the ray up to that piece.
+RAYS = [() if square & 0x88 else tuple(
+            (_ray(square, d), R | Q if d in MOVE_VECTORS[wR] else B | Q)
+            for d in MOVE_VECTORS[wQ] if _ray(square, d))
+        for square in range(128)]
+KNIGHT_SQUARES = [() if square & 0x88 else _neighbours(square, MOVE_VECTORS[wN])
+                  for square in range(128)]
+KING_SQUARES = [() if square & 0x88 else _neighbours(square, MOVE_VECTORS[wK])
+                for square in range(128)]
+# Squares a pawn of the given colour attacks a square from
+PAWN_ATTACKER_SQUARES = {
+    c: [() if square & 0x88 else _neighbours(square, [-m for m in MOVE_VECTORS[P | c] if m & 0xF])
+        for square in range(128)]
+    for c in COLOUR}
+
+
 # Piece and square evaluation from Simplified Evaluation by Tomasz Michniewski 
 # https://www.chessprogramming.org/Simplified_Evaluation_Function
 PIECE_VALUE = { K: 20_000,
@@ -153,17 +200,54 @@ King_endgame = ((-50,-40,-30,-20,-20,-30,-40,-50),
                 (-30,-30,  0,  0,  0,  0,-30,-30),
                 (-50,-30,-30,-30,-30,-30,-30,-50),) 
 
-PIECE_SQUARE_VALUE = {
-    k | p: tuple((s + PIECE_VALUE[k]) * (1 if p == w else -1)
-        for r in (v if p == w else reversed(v))
-        for s in r + OFF_0x88_BOARD)
-    for k,v in PIECE_SQUARE_BONUS.items()
-    for p in COLOUR
-}
-
-PIECE_SQUARE_VALUE[0] = (0,) * 128
+def _piece_square_values(bonus: Mapping[int, Tuple[Tuple[int, ...], ...]]) -> Dict[int, Tuple[int, ...]]:
+    values = {
+        k | p: tuple((s + PIECE_VALUE[k]) * (1 if p == w else -1)
+            for r in (v if p == w else reversed(v))
+            for s in r + OFF_0x88_BOARD)
+        for k,v in bonus.items()
+        for p in COLOUR
+    }
+    values[0] = (0,) * 128
+    return values
+
+PIECE_SQUARE_VALUE = _piece_square_values(PIECE_SQUARE_BONUS)
+# The same with the king's endgame table, evaluate blends the two by GAME_PHASE
+PIECE_SQUARE_VALUE_ENDGAME = _piece_square_values({**PIECE_SQUARE_BONUS, K: King_endgame})
+
+# Game phase of the pieces, the sum over the board is MAX_PHASE at the start
+# and falls towards 0 as pieces come off
+GAME_PHASE = {k | p: phase for k, phase in ((N, 1), (B, 1), (R, 2), (Q, 4), (P, 0), (K, 0)) 
+              for p in COLOUR}
+GAME_PHASE[0] = 0
+MAX_PHASE = 24
+
+# Zobrist keys, seeded so every process hashes positions the same way
+_zobrist_random = random.Random(0x88)
+ZOBRIST_PIECE = {piece: tuple(_zobrist_random.getrandbits(64) for _ in range(128))
+                 for piece in PIECES}
+ZOBRIST_PIECE[0] = (0,) * 128
+ZOBRIST_CASTLE = tuple(_zobrist_random.getrandbits(64) for _ in range(16))
+# Indexed by the ep square, OFF_THE_BOARD (no ep square) hashes to 0
+ZOBRIST_EP = tuple(_zobrist_random.getrandbits(64) for _ in range(128)) + (0,)
+ZOBRIST_BLACK = _zobrist_random.getrandbits(64)
 
 board_t = List[int]
+pieces_t = Dict[int, Set[int]]
+# Moves are ints, bits 0-6 from_square, 7-13 to_square, 14-19 pawn_promote,
+# 20-23 the castle rights given up, and the MOVE_FLAGS above that
+move_t = int
+MOVE_FLAGS = [CAPTURE_FLAG, EP_FLAG, DOUBLE_PUSH_FLAG, CASTLE_FLAG] = [
+    1 << 24, 1 << 25, 1 << 26, 1 << 27]
+# The bits that tell moves of a position apart, as written in UCI
+MOVE_KEY_MASK = (1 << 20) - 1
+PROMOTE_SHIFT = 14
+CASTLE_SHIFT = 20
+# from_square, to_square, moved_piece, captured_piece, 
+# ep_capture_square, ep_captured_piece, rook_from, rook_to
+undo_t = Tuple[int, int, int, int, int, int, int, int]
+# checking_squares, pinned_pieces, unsafe_squares, check, double_check
+attacks_t = Tuple[Set[int], Dict[int, Tuple[int, ...]], Set[int], bool, bool]
 class GameState(NamedTuple):
     board: board_t
     player: int
@@ -175,6 +259,20 @@ class GameState(NamedTuple):
     captured_piece: int
     moved_from_square: int
     moved_to_square: int
+    zobrist: int
+    # Sum of PIECE_SQUARE_VALUE over the board
+    score: int
+    # Sum of PIECE_SQUARE_VALUE_ENDGAME and of GAME_PHASE over the board
+    endgame_score: int
+    phase: int
+    # Pawns per file, a-h for white followed by a-h for black
+    pawn_files: Tuple[int, ...]
+    # zobrist of the pawns alone, the key of pawn_table
+    pawn_zobrist: int
+    # Occupied squares of each colour, shared and updated in place by make_move
+    piece_squares: pieces_t
+    # White and black king square
+    kings: Tuple[int, int]
 
 
 ENDC = '\033[0m'
@@ -194,46 +292,102 @@ def draw_board(board: board_t) -> None:
             print(f"\n     a b c d e f g h", end="\n\n")    
 
 
-def king_in_check_through_square(state: GameState, square: int) -> bool:
-    other_player = state.player ^ PLAYER_BITS
-    for dir_one, dir_two in ((north+west, south+east), 
-                             (north+east, south+west),
-                             (north, south), 
-                             (east, west)):
-        lookup_dir_one = lookup_dir_two = square
-        king_found = False
-        slider_found = False
-        while True:
-            lookup_dir_one += dir_one
-
-            if lookup_dir_one & 0x88: break
-            piece = state.board[lookup_dir_one]
-            if piece & state.player: 
-                king_found = piece & K > 0
-                break
-            elif piece & other_player:
-                slider_found = piece & SLIDER_PIECE > 0 and dir_two in MOVE_VECTORS[piece]
-                break
-
-        while True:
-            lookup_dir_two += dir_two
-            if lookup_dir_two & 0x88: break
-            piece = state.board[lookup_dir_two]
-            if piece & state.player: 
-                king_found = piece & K > 0
-                break
-            elif piece & other_player:
-                slider_found = piece & SLIDER_PIECE > 0 and dir_two in MOVE_VECTORS[piece]
-                break
-        if king_found and slider_found:
-            return True
+def attacked(board: board_t, square: int, by_player: int, 
+        empty: int = OFF_THE_BOARD) -> bool:
+    """Whether by_player attacks square, seen as if the piece on empty was lifted off"""
+    for s in KNIGHT_SQUARES[square]:
+        if board[s] == N | by_player: return True
+    for s in PAWN_ATTACKER_SQUARES[by_player][square]:
+        if board[s] == P | by_player: return True
+    for s in KING_SQUARES[square]:
+        if board[s] == K | by_player: return True
+    for ray, sliders in RAYS[square]:
+        for s in ray:
+            piece = board[s]
+            if not piece or s == empty: continue
+            if piece & by_player and piece & sliders: return True
+            break
     return False
 
 
 def generate_new_state(state: GameState, from_square: int, to_square: int, 
         ep_capture_square:int=OFF_THE_BOARD, ep_square:int=OFF_THE_BOARD, 
         castle:int=0, pawn_promote:int=0) -> GameState:
-    new_board = [*state.board]
+    new_pieces = {w: {*state.piece_squares[w]}, b: {*state.piece_squares[b]}}
+    new_state, _ = play_move(state, [*state.board], new_pieces, from_square, to_square, 
+        ep_capture_square, ep_square, castle, pawn_promote)
+    return new_state
+
+
+def make_move(state: GameState, move: move_t) -> Tuple[GameState, undo_t]:
+    """
+    Play move on state.board and state.piece_squares in place. The returned 
+    child state shares them with state until unmake_move restores them with 
+    the undo record.
+    """
+    from_square = move & 0x7f
+    to_square = move >> 7 & 0x7f
+    return play_move(state, state.board, state.piece_squares, from_square, to_square,
+        to_square + (south if to_square < 64 else north) if move & EP_FLAG else OFF_THE_BOARD,
+        (from_square + to_square) >> 1 if move & DOUBLE_PUSH_FLAG else OFF_THE_BOARD,
+        move >> CASTLE_SHIFT & 0xf, move >> PROMOTE_SHIFT & 0x3f)
+
+
+def decode_move(move: move_t) -> Tuple[int, int, int, int, int, int]:
+    """
+    from_square, to_square, ep_capture_square, ep_square, castle, pawn_promote 
+    of a move, the arguments of generate_new_state
+    """
+    from_square = move & 0x7f
+    to_square = move >> 7 & 0x7f
+    ep_capture_square = OFF_THE_BOARD
+    if move & EP_FLAG:
+        ep_capture_square = to_square + (south if to_square < 64 else north)
+    ep_square = (from_square + to_square) >> 1 if move & DOUBLE_PUSH_FLAG else OFF_THE_BOARD
+    return (from_square, to_square, ep_capture_square, ep_square, 
+            move >> CASTLE_SHIFT & 0xf, move >> PROMOTE_SHIFT & 0x3f)
+
+
+def move_to_uci(move: move_t) -> str:
+    promote = move >> PROMOTE_SHIFT & 0x3f
+    return (BOARD_NOTATION[move & 0x7f] + BOARD_NOTATION[move >> 7 & 0x7f] 
+            + (PROMOTE_PIECE_ENCODING[promote] if promote else ""))
+
+
+def uci_to_move(state: GameState, move: str) -> Optional[move_t]:
+    """The legal move written as move, None if there is none"""
+    key = parse_move_input(move)
+    for m in legal_moves(state):
+        if m & MOVE_KEY_MASK == key:
+            return m
+    return None
+
+
+def unmake_move(state: GameState, undo: undo_t) -> None:
+    from_square, to_square, moved_piece, captured_piece, \
+        ep_capture_square, ep_captured_piece, rook_from, rook_to = undo
+    board = state.board
+    board[from_square] = moved_piece
+    board[to_square] = captured_piece
+    own_pieces = state.piece_squares[moved_piece & PLAYER_BITS]
+    other_pieces = state.piece_squares[moved_piece & PLAYER_BITS ^ PLAYER_BITS]
+    own_pieces.discard(to_square)
+    own_pieces.add(from_square)
+    if captured_piece:
+        other_pieces.add(to_square)
+    if ep_capture_square < OFF_THE_BOARD:
+        board[ep_capture_square] = ep_captured_piece
+        other_pieces.add(ep_capture_square)
+    if rook_to < OFF_THE_BOARD:
+        board[rook_from], board[rook_to] = board[rook_to], 0
+        own_pieces.discard(rook_to)
+        own_pieces.add(rook_from)
+
+
+def play_move(state: GameState, new_board: board_t, new_pieces: pieces_t, 
+        from_square: int, to_square: int, 
+        ep_capture_square: int, ep_square: int, 
+        castle: int, pawn_promote: int) -> Tuple[GameState, undo_t]:
     player = state.player ^ PLAYER_BITS
     
     if player & w:
@@ -252,28 +406,42 @@ def generate_new_state(state: GameState, from_square: int, to_square: int,
     moved_to_square = to_square
 
     new_board[from_square], new_board[to_square] = 0, new_board[from_square]
+    own_pieces = new_pieces[state.player]
+    other_pieces = new_pieces[player]
+    own_pieces.discard(from_square)
+    own_pieces.add(to_square)
+    if captured_piece:
+        other_pieces.discard(to_square)
 
     # PROMOTION
     if pawn_promote:
         new_board[to_square] = pawn_promote | state.player
     
-    if ep_capture_square < len(new_board):
+    ep_captured_piece = 0
+    if ep_capture_square < OFF_THE_BOARD:
+        ep_captured_piece = new_board[ep_capture_square]
         new_board[ep_capture_square] = 0
+        other_pieces.discard(ep_capture_square)
 
+    rook_from = rook_to = OFF_THE_BOARD
     new_castle = state.castle & ~castle
     if castle:
         if castle == wOOO:
-            new_board[115], new_board[112] = wR, 0
+            rook_from, rook_to = 112, 115
             new_castle = state.castle & ~wc        
         elif castle == wOO:
-            new_board[117], new_board[119] = wR, 0
+            rook_from, rook_to = 119, 117
             new_castle = state.castle & ~wc
         elif castle & bOO and not(castle & bOOO):
-            new_board[5], new_board[7] = bR, 0
+            rook_from, rook_to = 7, 5
             new_castle = state.castle & ~bc
         elif castle & bOOO and not(castle & bOO):
-            new_board[3], new_board[0] = bR, 0
+            rook_from, rook_to = 0, 3
             new_castle = state.castle & ~bc
+        if rook_to < OFF_THE_BOARD:
+            new_board[rook_to], new_board[rook_from] = new_board[rook_from], 0
+            own_pieces.discard(rook_from)
+            own_pieces.add(rook_to)
             
     if new_castle:
         if new_castle & wOOO and new_board[112] != wR:
@@ -285,9 +453,69 @@ def generate_new_state(state: GameState, from_square: int, to_square: int,
         if new_castle & bOO and new_board[7] != bR:
             new_castle &= ~bOO
 
+    moved_piece = new_board[to_square]
+    zobrist = (state.zobrist ^ ZOBRIST_BLACK 
+        ^ ZOBRIST_PIECE[last_moved_piece][from_square] 
+        ^ ZOBRIST_PIECE[moved_piece][to_square] 
+        ^ ZOBRIST_PIECE[captured_piece][to_square]
+        ^ ZOBRIST_CASTLE[state.castle] ^ ZOBRIST_CASTLE[new_castle]
+        ^ ZOBRIST_EP[state.ep] ^ ZOBRIST_EP[ep_square])
+    score = (state.score 
+        - PIECE_SQUARE_VALUE[last_moved_piece][from_square]
+        + PIECE_SQUARE_VALUE[moved_piece][to_square]
+        - PIECE_SQUARE_VALUE[captured_piece][to_square])
+    endgame_score = (state.endgame_score 
+        - PIECE_SQUARE_VALUE_ENDGAME[last_moved_piece][from_square]
+        + PIECE_SQUARE_VALUE_ENDGAME[moved_piece][to_square]
+        - PIECE_SQUARE_VALUE_ENDGAME[captured_piece][to_square])
+    phase = (state.phase + GAME_PHASE[moved_piece] 
+        - GAME_PHASE[last_moved_piece] - GAME_PHASE[captured_piece])
+    if ep_captured_piece:
+        zobrist ^= ZOBRIST_PIECE[ep_captured_piece][ep_capture_square]
+        score -= PIECE_SQUARE_VALUE[ep_captured_piece][ep_capture_square]
+        endgame_score -= PIECE_SQUARE_VALUE_ENDGAME[ep_captured_piece][ep_capture_square]
+    if rook_to < OFF_THE_BOARD:
+        rook = new_board[rook_to]
+        zobrist ^= ZOBRIST_PIECE[rook][rook_from] ^ ZOBRIST_PIECE[rook][rook_to]
+        score += PIECE_SQUARE_VALUE[rook][rook_to] - PIECE_SQUARE_VALUE[rook][rook_from]
+        endgame_score += (PIECE_SQUARE_VALUE_ENDGAME[rook][rook_to] 
+                          - PIECE_SQUARE_VALUE_ENDGAME[rook][rook_from])
+
+    # Pawn files only change on pawn captures, promotions and captured pawns
+    pawn_files = state.pawn_files
+    if last_moved_piece & P and (pawn_promote or captured_piece or ep_captured_piece
+            ) or captured_piece & P:
+        new_files = [*pawn_files]
+        if last_moved_piece & P:
+            new_files[pawn_file(last_moved_piece, from_square)] -= 1
+            if not pawn_promote:
+                new_files[pawn_file(last_moved_piece, to_square)] += 1
+        if captured_piece & P:
+            new_files[pawn_file(captured_piece, to_square)] -= 1
+        if ep_captured_piece:
+            new_files[pawn_file(ep_captured_piece, ep_capture_square)] -= 1
+        pawn_files = tuple(new_files)
+
+    pawn_zobrist = state.pawn_zobrist
+    if last_moved_piece & P:
+        pawn_zobrist ^= ZOBRIST_PIECE[last_moved_piece][from_square]
+        if moved_piece & P:
+            pawn_zobrist ^= ZOBRIST_PIECE[moved_piece][to_square]
+        if ep_captured_piece:
+            pawn_zobrist ^= ZOBRIST_PIECE[ep_captured_piece][ep_capture_square]
+    if captured_piece & P:
+        pawn_zobrist ^= ZOBRIST_PIECE[captured_piece][to_square]
+
+    kings = state.kings
+    if last_moved_piece & K:
+        kings = (to_square, kings[1]) if state.player & w else (kings[0], to_square)
+
     return GameState(new_board, player, new_castle, 
         ep_square, pawnmove, num_moves, last_moved_piece, 
-        captured_piece, moved_from_square, moved_to_square)
+        captured_piece, moved_from_square, moved_to_square, zobrist, 
+        score, endgame_score, phase, pawn_files, pawn_zobrist, new_pieces, kings), (
+        from_square, to_square, last_moved_piece, captured_piece, 
+        ep_capture_square, ep_captured_piece, rook_from, rook_to)
 
 
 def generate_move_validation_state(state: GameState, new_squares: List[Tuple[int, int]]) -> GameState:
@@ -297,62 +525,72 @@ def generate_move_validation_state(state: GameState, new_squares: List[Tuple[int
     return state._replace(board=new_board)
 
 
-def move_generation(state: GameState) -> Dict[Tuple[int, ...], GameState]:
-    generated_moves: Dict[Tuple[int, ...], GameState] = {}
-    flags_board = [0] * len(state.board)
-    
-    other_player = state.player ^ PLAYER_BITS
-    checking_squares: Set[int] = set()
-    pinned_pieces: Dict[int, List[int]] = {}
-    unsafe_squares: Set[int] = set()
-    double_check = False
-    check = False
-    for square in range(128):
-        if square & 0x88: continue 
-        piece = state.board[square]
-        if not piece & other_player: continue
+def move_generation(state: GameState) -> Dict[move_t, GameState]:
+    return {m: generate_new_state(state, *decode_move(m)) for m in legal_moves(state)}
+
+
+def legal_moves(state: GameState) -> array:
+    return array("I", generate_moves(state, enemy_attacks(state)))
+
+
+def enemy_attacks(state: GameState) -> attacks_t:
+    """
+    Checks and pins found by looking out from our king along its 8 lines, 
+    knight jumps and pawn captures. Unsafe squares are only worked out for 
+    the squares the king can move or castle to.
+    """
+    board = state.board
+    player = state.player
+    other_player = player ^ PLAYER_BITS
+    king_square = state.kings[0 if player & w else 1]
+    checks: List[Tuple[int, ...]] = []
+    pinned_pieces: Dict[int, Tuple[int, ...]] = {}
+    for s in KNIGHT_SQUARES[king_square]:
+        if board[s] == N | other_player:
+            checks.append((s,))
+    for s in PAWN_ATTACKER_SQUARES[other_player][king_square]:
+        if board[s] == P | other_player:
+            checks.append((s,))
+    for ray, sliders in RAYS[king_square]:
+        possible_pin = None
+        for i, s in enumerate(ray):
+            piece = board[s]
+            if not piece: continue
+            if piece & player:
+                if possible_pin is not None: break
+                possible_pin = s
+                continue
+            if piece & sliders:
+                if possible_pin is None:
+                    checks.append(ray[:i + 1])
+                else:
+                    pinned_pieces[possible_pin] = ray[:i + 1]
+            break
 
-        for m in MOVE_VECTORS[piece]:
-            if piece & P and m in (north, south): continue
+    check = len(checks) > 0
+    double_check = len(checks) > 1
+    checking_squares = set(checks[0]) if check else set()
 
-            att_sqr = square
-            attack_list = [att_sqr]
-            possible_pin = None
-            while True:
-                att_sqr += m
-                if att_sqr & 0x88: break 
-                if state.board[att_sqr] & other_player: 
-                    if not possible_pin:
-                        unsafe_squares.add(att_sqr)
-                    break
-                    
-                attack_list.append(att_sqr)
-                if state.board[att_sqr] & state.player:
-                    if state.board[att_sqr] & K:
-                        if possible_pin:
-                            pinned_pieces[possible_pin] = attack_list[:-1]
-                            break
-                        else:
-                            if check:
-                                double_check = True
-                            else:
-                                checking_squares = set(attack_list)
-                                check = True
-                    else:
-                        if possible_pin: break
-                        possible_pin = att_sqr
-                if not possible_pin:
-                    unsafe_squares.add(att_sqr)
+    king_moves = [s for s in KING_SQUARES[king_square] if not board[s] & player]
+    if not check and state.castle & (wc if player & w else bc):
+        king_moves += [s for s in (king_square + east + east, king_square + west + west) 
+                       if 0 <= s < 128 and not s & 0x88]
+    unsafe_squares = {s for s in king_moves if attacked(board, s, other_player, king_square)}
+    return checking_squares, pinned_pieces, unsafe_squares, check, double_check
 
-                if not piece & SLIDER_PIECE: break
 
-    for square in range(128):
-        if square & 0x88: continue 
+def generate_moves(state: GameState, attacks: attacks_t, 
+        stage: int = ALL_MOVES) -> Iterator[move_t]:
+    checking_squares, pinned_pieces, unsafe_squares, check, double_check = attacks
+    other_player = state.player ^ PLAYER_BITS
+    captures = stage & CAPTURE_MOVES
+    quiets = stage & QUIET_MOVES
+    # Sorted so moves come in board order whatever order the set iterates in
+    for square in sorted(state.piece_squares[state.player]):
         piece = state.board[square]
-        if not piece & state.player: continue
 
         pinned = square in pinned_pieces
-        pinned_allowed_move = pinned_pieces.get(square, [])
+        pinned_allowed_move = pinned_pieces.get(square, ())
 
         # DOUBLE CHECK ONLY KING MOVES
         if double_check and not(piece & K): continue
@@ -376,237 +614,923 @@ def move_generation(state: GameState) -> Dict[Tuple[int, ...], GameState]:
                         # NORMAL MOVE
                         if not check or att_sqr in checking_squares:
                             if att_sqr <= 7 or att_sqr >= 112:
-                                for promote_to in (Q, R, B, N):
-                                    generated_moves[(square, att_sqr, promote_to)] = generate_new_state(
-                                        state, from_square=square, to_square=att_sqr, pawn_promote=promote_to)
-                            else:
-                                generated_moves[(square, att_sqr)] = generate_new_state(
-                                            state, from_square=square, to_square=att_sqr)
+                                if captures:
+                                    for promote_to in (Q, R, B, N):
+                                        yield square | att_sqr << 7 | promote_to << PROMOTE_SHIFT
+                            elif quiets:
+                                yield square | att_sqr << 7
                         # DOUBLE MOVE FROM INITIAL POSITION
-                        if (state.player & w and 96 <= square <= 103) or (
-                            state.player & b and 16 <= square <= 23):
+                        if quiets and ((state.player & w and 96 <= square <= 103) or (
+                            state.player & b and 16 <= square <= 23)):
                             double_move = att_sqr + m
                                     
                             if not state.board[double_move]:
                                 if not check or double_move in checking_squares:
-                                    generated_moves[(square, double_move)] = generate_new_state(
-                                        state, from_square=square, to_square=double_move, ep_square=att_sqr)
+                                    yield square | double_move << 7 | DOUBLE_PUSH_FLAG
 
                     else:
                         # ENPASSANT CAPTURE
-                        if att_sqr == state.ep:
+                        if not captures:
+                            pass
+                        elif att_sqr == state.ep:
                             ep_capture_square = state.ep + (south if state.player & w else north)   
                             if not check or att_sqr in checking_squares or ep_capture_square in checking_squares:
 
                                 validate_state = generate_move_validation_state(state, 
                                         new_squares=[(square, 0), (att_sqr, new_piece), (ep_capture_square, 0)])
-                                if not king_in_check_through_square(validate_state, ep_capture_square):
-                                    generated_moves[(square, att_sqr)] = generate_new_state(
-                                        state, from_square=square, to_square=att_sqr, ep_capture_square=ep_capture_square)
+                                if not attacked(validate_state.board, state.kings[0 if state.player & w else 1], other_player):
+                                    yield square | att_sqr << 7 | EP_FLAG | CAPTURE_FLAG
 
                         # CAPTURE
                         elif state.board[att_sqr] & other_player:
                             if not check or att_sqr in checking_squares:
                                 if att_sqr <= 7 or att_sqr >= 112:
                                     for promote_to in (Q, R, B, N):
-                                        generated_moves[(square, att_sqr, promote_to)] = generate_new_state(
-                                            state, from_square=square, to_square=att_sqr, pawn_promote=promote_to)
+                                        yield (square | att_sqr << 7 | promote_to << PROMOTE_SHIFT 
+                                               | CAPTURE_FLAG)
                                 else:
-                                    generated_moves[(square, att_sqr)] = generate_new_state(
-                                            state, from_square=square, to_square=att_sqr)
+                                    yield square | att_sqr << 7 | CAPTURE_FLAG
                 
                 #KING RULES
                 elif piece & K:
                     #CASTLE
                     castlemask = wc if state.player & w else bc
                     can_castle = state.castle & castlemask
-                    if not (check or double_check) and can_castle:
+                    if quiets and not (check or double_check) and can_castle:
                         double_move = att_sqr + m
                         if m == east and can_castle & OO:
                             if not (state.board[att_sqr] | state.board[double_move]
                                 ) and (att_sqr not in unsafe_squares and double_move not in unsafe_squares):
-                                generated_moves[(square, double_move)] = generate_new_state(state, 
-                                    from_square=square, to_square=double_move, castle=can_castle&OO)
+                                yield (square | double_move << 7 
+                                       | (can_castle&OO) << CASTLE_SHIFT | CASTLE_FLAG)
 
                         elif m == west and can_castle & OOO:
                             tripple_move = double_move + m
                             if not (state.board[att_sqr] | state.board[double_move] | state.board[tripple_move]
                                 ) and (att_sqr not in unsafe_squares and double_move not in unsafe_squares):
-                                generated_moves[(square, double_move)] = generate_new_state(state, 
-                                    from_square=square, to_square=double_move, castle=can_castle&OOO)
+                                yield (square | double_move << 7 
+                                       | (can_castle&OOO) << CASTLE_SHIFT | CASTLE_FLAG)
                     
-                    if not att_sqr in unsafe_squares:
-                        generated_moves[(square, att_sqr)] = generate_new_state(state, 
-                            from_square=square, to_square=att_sqr, castle=castlemask)
+                    if not att_sqr in unsafe_squares and (
+                            captures if state.board[att_sqr] else quiets):
+                        yield (square | att_sqr << 7 | castlemask << CASTLE_SHIFT 
+                               | (CAPTURE_FLAG if state.board[att_sqr] else 0))
 
                 else:
-                    if not check or att_sqr in checking_squares:
-                        generated_moves[(square, att_sqr)] = generate_new_state(state, 
-                            from_square=square, to_square=att_sqr)
+                    if (not check or att_sqr in checking_squares) and (
+                            captures if state.board[att_sqr] else quiets):
+                        yield square | att_sqr << 7 | (CAPTURE_FLAG if state.board[att_sqr] else 0)
 
                 if state.board[att_sqr] & other_player: break
                 if not piece & SLIDER_PIECE: break
 
-    return generated_moves
+
+def count_moves(state: GameState, attacks: attacks_t) -> int:
+    """Number of moves generate_moves yields, counted without making their states"""
+    return sum(1 for _ in generate_moves(state, attacks))
+
 
 
 searched = 0
 MATE = 2 * PIECE_VALUE[K]
 ALPHABETA = 99999999999999
 
+BOUNDS = [EXACT, LOWER_BOUND, UPPER_BOUND] = [0, 1, 2]
+TT_SIZE_MB = 64
+# Rough size of one entry tuple with its key, score and move in CPython
+TT_ENTRY_BYTES = 256
+
+# zobrist, depth, score, bound, best_move, generation
+tt_entry_t = Tuple[int, int, int, int, Optional[move_t], int]
+class TranspositionTable:
+    """
+    Fixed size table of search results keyed by zobrist hash. Every bucket has 
+    a depth-preferred slot, kept until a deeper search or a newer generation 
+    replaces it, and an always-replace slot for everything else.
+    """
+    def __init__(self, size_mb: int = TT_SIZE_MB) -> None:
+        self.resize(size_mb)
+
+    def resize(self, size_mb: int) -> None:
+        self.num_buckets = max(1, size_mb * 2**20 // (2 * TT_ENTRY_BYTES))
+        self.entries: List[Optional[tt_entry_t]] = [None] * (2 * self.num_buckets)
+        self.generation = 0
+
+    def clear(self) -> None:
+        self.entries = [None] * (2 * self.num_buckets)
+        self.generation = 0
+
+    def new_search(self) -> None:
+        self.generation += 1
+
+    def probe(self, zobrist: int) -> Optional[tt_entry_t]:
+        index = zobrist % self.num_buckets << 1
+        entry = self.entries[index]
+        if entry is not None and entry[0] == zobrist:
+            return entry
+        entry = self.entries[index | 1]
+        if entry is not None and entry[0] == zobrist:
+            return entry
+        return None
+
+    def store(self, zobrist: int, depth: int, score: int, bound: int, 
+              best_move: Optional[move_t]) -> None:
+        index = zobrist % self.num_buckets << 1
+        preferred = self.entries[index]
+        if (preferred is None or preferred[0] == zobrist or depth >= preferred[1]
+                or preferred[5] != self.generation):
+            if best_move is None and preferred is not None and preferred[0] == zobrist:
+                best_move = preferred[4]
+            self.entries[index] = (zobrist, depth, score, bound, best_move, self.generation)
+        else:
+            self.entries[index | 1] = (zobrist, depth, score, bound, best_move, self.generation)
+
+transposition_table = TranspositionTable()
+
+
+def tt_score(score: int, stored_depth: int, depth: int) -> Optional[int]:
+    """
+    Stored score as seen from a node searched to depth. Mate scores scale with 
+    one more than the depth left at the mated node, so they are shifted to the 
+    new depth and dropped if the mate lies beyond it.
+    """
+    if score >= MATE:
+        score -= MATE * (stored_depth - depth)
+        return score if score >= MATE else None
+    if score <= -MATE:
+        score += MATE * (stored_depth - depth)
+        return score if score <= -MATE else None
+    return score
+
+
+class SearchTimeout(Exception):
+    """Raised from alphabeta when the search deadline or node limit has passed"""
+
+
+class SearchOptions(NamedTuple):
+    # Extend alphabeta leaves with a capture search, so a capture at the 
+    # horizon is not scored before the recapture
+    quiescence: bool = True
+    # Processes the root moves are split over, 1 searches in this process
+    workers: int = 1
+    # Forward pruning, each off by default so search(state, depth) stays 
+    # full width and can be compared against with search_stats
+    null_move: bool = False
+    late_move_reductions: bool = False
+    futility: bool = False
+
+search_options = SearchOptions()
+DELTA_MARGIN = 2 * PIECE_VALUE[P]
+NULL_MOVE_REDUCTION = 2
+# Moves searched at full depth before the rest are reduced, and the least 
+# depth left at which they are
+LMR_FULL_MOVES = 3
+LMR_MIN_DEPTH = 3
+# Margins by depth left below which quiet moves are pruned, and below which 
+# a node one ply from the leaves drops into quiescence
+FUTILITY_MARGIN = [0, 2 * PIECE_VALUE[P], 5 * PIECE_VALUE[P]]
+RAZOR_MARGIN = 3 * PIECE_VALUE[P]
+
+# What the forward pruning did during the last search, and the seconds 
+# spent in its sub-searches, a sub-search nested in one of the same kind 
+# counted once
+search_stats: Counter = Counter()
+search_times: Dict[str, float] = {}
+timed_techniques: Set[str] = set()
+# Endgame tables alphabeta takes exact scores from, a tablebase.Tablebase 
+# set by whoever loads one (tablebase imports this module), None to search on
+endgame_tables: Optional["tablebase.Tablebase"] = None
+
+nodes = 0
+# time.time() after which alphabeta aborts, None to search without a limit
+deadline: Optional[float] = None
+# Node count after which alphabeta aborts, None for no limit
+node_limit: Optional[int] = None
+# Set from another thread to abort the search as if the deadline had passed
+stop_requested = False
+# Set by the main process to abort the searches of the pool workers
+worker_stop: Optional[multiprocessing.synchronize.Event] = None
+MAX_DEPTH = 64
+MOVES_TO_GO = 30
+MOVE_OVERHEAD = 50
+
+def search_stopped() -> bool:
+    return (stop_requested or deadline is not None and time.time() > deadline
+            or node_limit is not None and nodes >= node_limit
+            or worker_stop is not None and worker_stop.is_set())
+
+
+def time_budget(player: int, movetime: Optional[int] = None, 
+                wtime: Optional[int] = None, btime: Optional[int] = None, 
+                winc: int = 0, binc: int = 0, 
+                movestogo: Optional[int] = None) -> Optional[float]:
+    """Seconds to spend on a move from times in milliseconds, None for no limit"""
+    if movetime is not None:
+        return movetime / 1000
+    time_left, increment = (wtime, winc) if player & w else (btime, binc)
+    if time_left is None:
+        return None
+    budget = time_left / (movestogo or MOVES_TO_GO) + increment * 3 / 4
+    return max(0, min(budget, time_left - MOVE_OVERHEAD)) / 1000
+
+
+def root_moves(state: GameState) -> List[move_t]:
+    board = state.board
+    return sorted(legal_moves(state), key=lambda m: move_value(board, m), reverse=True)
+
+
 def search(state: GameState, depth: int, print_status: bool = False):
-    global searched
-    searched = 0
-    next_states: List[GameState] = sorted(move_generation(state).values(), 
-                         key=move_order_value, reverse=True)
-    # move_scores = {}
-    alpha = -ALPHABETA
-    beta = ALPHABETA
-    num_moves = len(next_states)
+    global searched, nodes
+    searched = nodes = 0
+    search_stats.clear()
+    search_times.clear()
+    start = time.time()
+    transposition_table.new_search()
+    clear_move_ordering()
+    best_move, _ = search_root(state, depth, root_moves(state), print_status)
+    print_search_stats(start)
+    
+    if best_move is None:
+        return None
+    return generate_new_state(state, *decode_move(best_move))
+
+
+def iterative_deepening(state: GameState, max_depth: int = MAX_DEPTH, 
+        movetime: Optional[int] = None, wtime: Optional[int] = None, 
+        btime: Optional[int] = None, winc: int = 0, binc: int = 0, 
+        movestogo: Optional[int] = None, print_status: bool = False, 
+        max_nodes: Optional[int] = None, 
+        report: Optional[Callable[[int, int, move_t], None]] = None
+        ) -> Tuple[Optional[move_t], Optional[int]]:
+    """
+    Search depth 1, 2, 3, ... until max_depth, the time budget or max_nodes is 
+    used up or stop_requested is set, and return the best move of the deepest 
+    completed depth and its score. The score is None if depth 1 was stopped 
+    and the move None if there are no legal moves. report is called with the 
+    depth, score and best move whenever a depth completes.
+    """
+    global searched, nodes, deadline, node_limit
+    searched = nodes = 0
+    search_stats.clear()
+    search_times.clear()
+    transposition_table.new_search()
+    clear_move_ordering()
+    start = time.time()
+    budget = time_budget(state.player, movetime, wtime, btime, winc, binc, movestogo)
+    moves = root_moves(state)
+    entry = transposition_table.probe(state.zobrist)
+    if entry is not None and entry[4] in moves:
+        moves.remove(entry[4])
+        moves.insert(0, entry[4])
+
+    board = [*state.board]
+    pieces = {c: {*s} for c, s in state.piece_squares.items()}
+    best_move: Optional[move_t] = None
+    score: Optional[int] = None
+    for depth in range(1, max_depth + 1):
+        # Always finish depth 1 so there is a move to play
+        if depth > 1:
+            deadline = None if budget is None else start + budget
+            node_limit = max_nodes
+        try:
+            move, score = aspiration_search(state, depth, moves, score, print_status)
+        except SearchTimeout:
+            state.board[:] = board
+            for c, s in pieces.items():
+                state.piece_squares[c].clear()
+                state.piece_squares[c].update(s)
+            # Only a stop request gets here before depth 1 is done
+            if best_move is None and moves:
+                best_move, score = moves[0], None
+            break
+        finally:
+            deadline = node_limit = None
+        if move is None: break
+        best_move = move
+        moves.remove(move)
+        moves.insert(0, move)
+        if report is not None:
+            report(depth, score, move)
+        if print_status:
+            pv = " ".join(move_to_uci(m) for m in principal_variation(state, depth))
+            print(f"depth {depth} score {score} pv {pv}")
+        # The next depth would most likely not finish in time
+        if budget is not None and time.time() - start > budget / 2: break
+    if print_status:
+        print_search_stats(start)
+    return best_move, score
+
+
+def print_search_stats(start: float) -> None:
+    print("Searched", searched)
+    if search_options.null_move or search_options.late_move_reductions or search_options.futility:
+        elapsed = time.time() - start
+        counts = ", ".join(f"{key} {count}" for key, count in sorted(search_stats.items()))
+        print(f"Nodes {nodes} in {elapsed:.2f}s ({nodes / max(elapsed, 1e-6):.0f}/s): {counts}")
+        if search_times:
+            print("Time in", ", ".join(f"{key} {seconds:.2f}s" 
+                                      for key, seconds in sorted(search_times.items())))
+
+
+ASPIRATION_WINDOW = PIECE_VALUE[P] // 2
+def aspiration_search(state: GameState, depth: int, moves: List[move_t], 
+                      score: Optional[int] = None, 
+                      print_status: bool = False) -> Tuple[Optional[move_t], int]:
+    """
+    search_root in a window around score, the previous depth's score. If the 
+    result falls outside, the side it failed on is opened and searched again.
+    """
+    if score is None or search_options.workers > 1:
+        return search_root(state, depth, moves, print_status)
+    alpha, beta = score - ASPIRATION_WINDOW, score + ASPIRATION_WINDOW
+    while True:
+        move, score = search_root(state, depth, moves, print_status, alpha, beta)
+        if score <= alpha:
+            alpha = -ALPHABETA
+        elif score >= beta:
+            beta = ALPHABETA
+        else:
+            return move, score
+
+
+def principal_variation(state: GameState, max_length: int) -> List[move_t]:
+    """The best moves from state on, as far as the transposition table has them"""
+    pv: List[move_t] = []
+    played = []
+    seen = set()
+    while len(pv) < max_length and state.zobrist not in seen:
+        entry = transposition_table.probe(state.zobrist)
+        if entry is None: break
+        move = entry[4]
+        if move is None or move not in legal_moves(state): break
+        seen.add(state.zobrist)
+        pv.append(move)
+        state, undo = make_move(state, move)
+        played.append((state, undo))
+    for child, undo in reversed(played):
+        unmake_move(child, undo)
+    return pv
+
+
+def search_root(state: GameState, depth: int, moves: List[move_t], 
+                print_status: bool = False, alpha: int = -ALPHABETA, 
+                beta: int = ALPHABETA) -> Tuple[Optional[move_t], int]:
+    """
+    Best move and its score from the view of the side to move. The first move 
+    in moves wins among equal scores. A score outside alpha and beta is only 
+    a bound, and the move is not to be trusted.
+    """
+    if search_options.workers > 1 and len(moves) > 1:
+        return search_root_parallel(state, depth, moves, print_status)
+    alpha_orig = alpha
+    num_moves = len(moves)
     best_move = None
-    for i, ns in enumerate(next_states):
+    best_score = -ALPHABETA
+    for i, m in enumerate(moves):
         if print_status:
             print(f"\rThinking of move {i+1:>3}/{num_moves}, depth = {depth}", end= "")
-        score = alphabeta(ns, depth - 1, alpha, beta, ns.player == w)
-        # move_scores[score] = move_scores.get(score, []) + [ns]
-        if state.player == w:
-            if score > alpha:
-                alpha = score
-                best_move = ns
+        ns, undo = make_move(state, m)
+        if i == 0:
+            score = -alphabeta(ns, depth - 1, -beta, -alpha)
         else:
-            if score < beta:
-                beta = score
-                best_move = ns
+            score = -alphabeta(ns, depth - 1, -alpha - 1, -alpha)
+            if alpha < score < beta:
+                score = -alphabeta(ns, depth - 1, -beta, -alpha)
+        unmake_move(ns, undo)
+        if score > best_score:
+            best_score = score
+            best_move = m
+        alpha = max(alpha, score)
         if print_status:
-            print(f", best score = {alpha if state.player == w else beta: <20}", end="")
+            print(f", best score = {best_score: <20}", end="")
+        if alpha >= beta: break
     if print_status:
         print("\n")
-    print("Searched", searched)
     
-    # best_moves = move_scores.get(beta, [])
-    return best_move #random.choice(best_moves) if best_moves else None
+    if best_move is not None:
+        if best_score <= alpha_orig:
+            bound = UPPER_BOUND
+        elif best_score >= beta:
+            bound = LOWER_BOUND
+        else:
+            bound = EXACT
+        transposition_table.store(state.zobrist, depth, best_score, bound, best_move)
+    return best_move, best_score
+
+
+# Best root score found so far by any worker, from the side to move's view, 
+# and the event that stops them, made along with the pool and handed to its 
+# workers
+shared_best: Optional[Synchronized] = None
+shared_stop: Optional[multiprocessing.synchronize.Event] = None
+search_pool: Optional[multiprocessing.pool.Pool] = None
+# The search_options the pool workers were started with
+search_pool_options: Optional[SearchOptions] = None
+# transposition_table.generation of the search a worker last took a task of
+worker_search: Optional[int] = None
+
+
+# Seconds between checks of search_stopped while waiting for the workers
+WORKER_POLL = 0.05
+
+
+def init_search_worker(options: SearchOptions, best: Synchronized, 
+                       stop: multiprocessing.synchronize.Event) -> None:
+    # A forked worker inherits the limits of the search that made the pool, 
+    # the main process watches those and stops the workers through stop
+    global search_options, deadline, node_limit, shared_best, worker_stop
+    search_options = options
+    deadline = node_limit = None
+    shared_best = best
+    worker_stop = stop
+
+
+def get_search_pool(options: SearchOptions) -> Tuple[multiprocessing.pool.Pool, Synchronized, 
+                                                     multiprocessing.synchronize.Event]:
+    """The pool of options.workers processes, made again when the options change"""
+    global search_pool, search_pool_options, shared_best, shared_stop
+    if (search_pool is None or shared_best is None or shared_stop is None 
+            or search_pool_options != options):
+        if search_pool is not None:
+            search_pool.terminate()
+        shared_best = multiprocessing.Value("q", -ALPHABETA)
+        shared_stop = multiprocessing.Event()
+        search_pool = multiprocessing.Pool(options.workers, init_search_worker, 
+                                           (options, shared_best, shared_stop))
+        search_pool_options = options
+    return search_pool, shared_best, shared_stop
+
+
+def search_child(task):
+    """
+    Worker for the process pool, scores one root move. The window is opened 
+    one below the best root score so far, so a move scoring the same as the 
+    best is scored exactly and ties can be broken on move order like search_root.
+    """
+    global searched, worker_search
+    index, position, depth, generation = task
+    searched = 0
+    if generation != worker_search:
+        # The first task of a new search, as search does in the main process
+        worker_search = generation
+        transposition_table.new_search()
+        clear_move_ordering()
+    best = shared_best.value
+    alpha = best - 1 if best > -ALPHABETA else -ALPHABETA
+    state = decode_position(position)
+    try:
+        score = -alphabeta(state, depth, -ALPHABETA, -alpha)
+    except SearchTimeout:
+        return index, None, searched
+    with shared_best.get_lock():
+        shared_best.value = max(shared_best.value, score)
+    return index, score, searched
+
+
+def search_root_parallel(state: GameState, depth: int, moves: List[move_t], 
+                         print_status: bool = False) -> Tuple[Optional[move_t], int]:
+    """
+    search_root with the root moves split over search_options.workers processes. 
+    Children are sent to the workers packed with encode_position.
+    """
+    global searched
+    pool, best, stop = get_search_pool(search_options)
+    best.value = -ALPHABETA
+    stop.clear()
+    tasks = [(i, encode_position(generate_new_state(state, *decode_move(m))), depth - 1, 
+              transposition_table.generation) 
+             for i, m in enumerate(moves)]
+    scores: List[int] = [0] * len(moves)
+    timed_out = False
+    results = pool.imap_unordered(search_child, tasks)
+    for done in range(len(tasks)):
+        # The deadline, node limit and a stop from another thread are 
+        # passed on to the workers
+        while True:
+            try:
+                i, score, child_searched = results.next(WORKER_POLL)
+                break
+            except multiprocessing.TimeoutError:
+                if search_stopped():
+                    stop.set()
+        searched += child_searched
+        if score is None:
+            timed_out = True
+        else:
+            scores[i] = score
+        if print_status:
+            print(f"\rThinking of move {done+1:>3}/{len(moves)}, depth = {depth}", end= "")
+    if print_status:
+        print("\n")
+    if timed_out:
+        raise SearchTimeout
+
+    best_score = max(scores)
+    best_move = moves[scores.index(best_score)]
+    transposition_table.store(state.zobrist, depth, best_score, EXACT, best_move)
+    return best_move, best_score
 
 
-def move_order_value(state: GameState) -> int:
-    moved_piece = state.last_moved_piece
-    captured_piece = state.captured_piece
-    pos_matrix = PIECE_SQUARE_VALUE[moved_piece]
+def move_value(board: board_t, move: move_t) -> int:
+    """Piece square improvement of a move plus the value of what it captures"""
+    from_square, to_square = move & 0x7f, move >> 7 & 0x7f
+    pos_matrix = PIECE_SQUARE_VALUE[board[from_square]]
     
-    improvement = abs(pos_matrix[state.moved_to_square] - pos_matrix[state.moved_from_square])
-    capture_value = PIECE_VALUE[captured_piece & ~PLAYER_BITS]
+    improvement = abs(pos_matrix[to_square] - pos_matrix[from_square])
+    capture_value = PIECE_VALUE[board[to_square] & ~PLAYER_BITS]
     return improvement + capture_value
 
 
-def alphabeta(state, depth, alpha, beta, maximizingPlayer):
-    next_states = move_generation(state).values()
-    next_states = sorted(next_states, key=move_order_value, reverse=True)
-    if depth == 0 or len(next_states) == 0:
-        global searched
+# Quiet moves that caused a beta cutoff, two per ply from the root, and 
+# cutoffs per from and to square weighted by depth
+killer_moves: List[List[move_t]] = [[0, 0] for _ in range(MAX_DEPTH + 1)]
+history = [0] * (1 << 14)
+KILLER_SCORE = 1 << 40
+# Least valuable attacker first among captures of the same victim
+LVA_RANK = {P: 5, N: 4, B: 3, R: 2, Q: 1, K: 0}
+
+
+def clear_move_ordering() -> None:
+    for killers in killer_moves:
+        killers[:] = [0, 0]
+    history[:] = [0] * len(history)
+
+
+def capture_score(board: board_t, move: move_t) -> int:
+    """MVV-LVA, most valuable victim first then least valuable attacker"""
+    return capture_gain(board, move) * 8 + LVA_RANK[board[move & 0x7f] & ~PLAYER_BITS]
+
+
+def quiet_score(board: board_t, move: move_t, killers: List[move_t]) -> int:
+    if move in killers:
+        return KILLER_SCORE - killers.index(move)
+    return history[move & 0x3fff] + move_value(board, move)
+
+
+def store_cutoff(move: move_t, depth: int, ply: int) -> None:
+    """Remember a quiet move that caused a beta cutoff"""
+    if move & (CAPTURE_FLAG | 0x3f << PROMOTE_SHIFT): return
+    killers = killer_moves[ply]
+    if killers[0] != move:
+        killers[1], killers[0] = killers[0], move
+    history[move & 0x3fff] += depth * depth
+
+
+def pick_best(moves: List[move_t], scores: List[int]) -> Iterator[move_t]:
+    """
+    Yield moves highest score first, equal scores in generation order. Each 
+    move is found by selection when it is needed, so a cutoff after the first 
+    few moves does not pay for sorting the rest.
+    """
+    while moves:
+        i = scores.index(max(scores))
+        scores.pop(i)
+        yield moves.pop(i)
+
+
+def ordered_moves(state: GameState, attacks: attacks_t, 
+                  hash_move: Optional[move_t] = None, ply: int = 0) -> Iterator[move_t]:
+    """
+    Legal moves in search order: the hash move if it is legal here, captures 
+    and promotions by MVV-LVA, then killer moves and other quiet moves by 
+    history. A stage is generated only when it is reached.
+    """
+    board = state.board
+    hash_stage = 0
+    if hash_move is not None:
+        hash_stage = CAPTURE_MOVES if hash_move & (CAPTURE_FLAG | 0x3f << PROMOTE_SHIFT
+            ) else QUIET_MOVES
+        hash_stage_moves = list(generate_moves(state, attacks, hash_stage))
+        if hash_move in hash_stage_moves:
+            hash_stage_moves.remove(hash_move)
+            yield hash_move
+    for stage in MOVE_STAGES:
+        if stage == hash_stage:
+            stage_moves = hash_stage_moves
+        else:
+            stage_moves = list(generate_moves(state, attacks, stage))
+        if stage == CAPTURE_MOVES:
+            scores = [capture_score(board, m) for m in stage_moves]
+        else:
+            killers = killer_moves[ply]
+            scores = [quiet_score(board, m, killers) for m in stage_moves]
+        yield from pick_best(stage_moves, scores)
+
+
+def alphabeta(state, depth, alpha, beta, ply=1, allow_null=True):
+    """
+    Negamax principal variation search, scores are from the view of the side 
+    to move. The first move is searched with the full window, the rest with 
+    a null window and only searched again if they beat alpha. The forward 
+    pruning in search_options is applied to nodes out of check, allow_null is 
+    False right after a null move so two are never played in a row. ply is 
+    the distance from the root, which the killer moves are kept by.
+    """
+    global searched, nodes
+    nodes += 1
+    if not nodes & 0x3f and search_stopped():
+        raise SearchTimeout()
+
+    hash_move = None
+    entry = transposition_table.probe(state.zobrist)
+    if entry is not None:
+        _, stored_depth, stored_score, bound, hash_move, _ = entry
+        # Without quiescence the leaf scores swing with the parity of the depth, 
+        # so only scores of searches an even number of plies deeper agree with 
+        # the rest of the tree
+        if stored_depth >= depth and (search_options.quiescence or not (stored_depth - depth) & 1):
+            score = tt_score(stored_score, stored_depth, depth)
+            if score is not None:
+                if bound == EXACT: 
+                    return score
+                if bound == LOWER_BOUND: 
+                    alpha = max(alpha, score)
+                elif bound == UPPER_BOUND: 
+                    beta = min(beta, score)
+                if alpha >= beta: 
+                    return score
+
+    if (endgame_tables is not None and len(state.piece_squares[w]) 
+            + len(state.piece_squares[b]) <= endgame_tables.max_pieces):
+        score = endgame_tables.probe_score(state)
+        if score is not None:
+            search_stats["tablebase hits"] += 1
+            return score
+
+    attacks = enemy_attacks(state)
+    colour = 1 if state.player & w else -1
+    if depth == 0:
+        if not search_options.quiescence:
+            searched += 1
+            value = colour * evaluate(state, count_moves(state, attacks), depth)
+            transposition_table.store(state.zobrist, depth, value, EXACT, None)
+            return value
+        value = quiescence(state, alpha, beta, attacks)
+        if value <= alpha:
+            bound = UPPER_BOUND
+        elif value >= beta:
+            bound = LOWER_BOUND
+        else:
+            bound = EXACT
+        transposition_table.store(state.zobrist, depth, value, bound, None)
+        return value
+
+    check = attacks[3]
+    if (search_options.null_move and allow_null and not check 
+            and depth > NULL_MOVE_REDUCTION and beta < MATE and has_pieces(state)):
+        search_stats["null move tries"] += 1
+        score = -timed_search("null move", alphabeta, null_move(state), 
+                              depth - 1 - NULL_MOVE_REDUCTION, -beta, -beta + 1, ply + 1, False)
+        if score >= beta:
+            search_stats["null move cutoffs"] += 1
+            # A mate found after passing is not proven for the real moves
+            return beta if score >= MATE else score
+
+    # Static evaluation near the leaves for futility pruning and razoring
+    futile = False
+    if search_options.futility and depth < len(FUTILITY_MARGIN) and not check and alpha > -MATE:
+        num_moves = count_moves(state, attacks)
+        static = colour * evaluate(state, num_moves, depth) if num_moves else alpha
+        if depth == 1 and static + RAZOR_MARGIN <= alpha:
+            search_stats["razor tries"] += 1
+            score = timed_search("razoring", quiescence, state, alpha, beta, attacks)
+            if score <= alpha:
+                search_stats["razor cutoffs"] += 1
+                return score
+        futile = static + FUTILITY_MARGIN[depth] <= alpha
+
+    # Quiet moves are only generated if no capture or promotion cuts off
+    alpha_orig = alpha
+    best_move = None
+    value = -ALPHABETA
+    killers = killer_moves[ply]
+    for i, m in enumerate(ordered_moves(state, attacks, hash_move, ply)):
+        quiet = not m & (CAPTURE_FLAG | 0x3f << PROMOTE_SHIFT)
+        ns, undo = make_move(state, m)
+        if quiet and i and (futile or search_options.late_move_reductions) and not check:
+            gives_check = attacked(ns.board, ns.kings[0 if ns.player & w else 1], state.player)
+        else:
+            gives_check = True
+        if futile and quiet and not gives_check and best_move is not None:
+            search_stats["futility pruned"] += 1
+            unmake_move(ns, undo)
+            continue
+        if i == 0:
+            score = -alphabeta(ns, depth - 1, -beta, -alpha, ply + 1)
+        else:
+            score = alpha + 1
+            if (search_options.late_move_reductions and quiet and not gives_check 
+                    and i >= LMR_FULL_MOVES and depth >= LMR_MIN_DEPTH and m not in killers):
+                search_stats["reductions"] += 1
+                score = -timed_search("reductions", alphabeta, ns, depth - 2, -alpha - 1, -alpha, ply + 1)
+                if score > alpha:
+                    search_stats["reduction re-searches"] += 1
+            if score > alpha:
+                score = -alphabeta(ns, depth - 1, -alpha - 1, -alpha, ply + 1)
+            if alpha < score < beta:
+                score = -alphabeta(ns, depth - 1, -beta, -alpha, ply + 1)
+        unmake_move(ns, undo)
+        if score > value:
+            value = score
+            best_move = m
+        alpha = max(alpha, value)
+        if alpha >= beta: 
+            store_cutoff(m, depth, ply)
+            break
+
+    if best_move is None:
         searched += 1
-        return evaluate(state, next_states, depth)
+        value = colour * evaluate(state, 0, depth)
+        transposition_table.store(state.zobrist, depth, value, EXACT, None)
+        return value
 
-    if maximizingPlayer:
+    if value <= alpha_orig:
+        bound = UPPER_BOUND
+    elif value >= beta:
+        bound = LOWER_BOUND
+    else:
+        bound = EXACT
+    transposition_table.store(state.zobrist, depth, value, bound, best_move)
+    return value
+
+def timed_search(technique: str, search: Callable[..., int], *args) -> int:
+    """search(*args) with the time it takes added to search_times[technique]"""
+    if technique in timed_techniques:
+        return search(*args)
+    timed_techniques.add(technique)
+    started = time.perf_counter()
+    try:
+        return search(*args)
+    finally:
+        timed_techniques.discard(technique)
+        search_times[technique] = search_times.get(technique, 0) + time.perf_counter() - started
+
+
+def has_pieces(state: GameState) -> bool:
+    """
+    Whether the side to move has more than pawns and a king. Without, passing 
+    is often the best move (zugzwang) and a null move search would be wrong.
+    """
+    board = state.board
+    return any(board[square] & (R | N | B | Q) for square in state.piece_squares[state.player])
+
+
+def null_move(state: GameState) -> GameState:
+    """state with the other side to move, as if the side to move passed"""
+    return state._replace(player=state.player ^ PLAYER_BITS, ep=OFF_THE_BOARD, 
+        zobrist=state.zobrist ^ ZOBRIST_BLACK ^ ZOBRIST_EP[state.ep] ^ ZOBRIST_EP[OFF_THE_BOARD])
+
+
+def capture_gain(board: board_t, move: move_t) -> int:
+    """Material won by a capture or promotion"""
+    gain = PIECE_VALUE[board[move >> 7 & 0x7f] & ~PLAYER_BITS]
+    if move & EP_FLAG:
+        gain += PIECE_VALUE[P]
+    promote = move >> PROMOTE_SHIFT & 0x3f
+    if promote:
+        gain += PIECE_VALUE[promote] - PIECE_VALUE[P]
+    return gain
+
+
+def quiescence(state, alpha, beta, attacks):
+    """
+    Search captures and promotions until the position is quiet. The side to 
+    move may stand pat on the static evaluation unless it is in check, in 
+    which case every evasion is searched. Captures that cannot bring the 
+    score back to the window even with DELTA_MARGIN to spare are pruned.
+    """
+    global searched, nodes
+    nodes += 1
+    if not nodes & 0x3f and search_stopped():
+        raise SearchTimeout()
+
+    searched += 1
+    num_moves = count_moves(state, attacks)
+    stand_pat = (1 if state.player & w else -1) * evaluate(state, num_moves, 0)
+    if not num_moves:
+        return stand_pat
+
+    board = state.board
+    check = attacks[3]
+    if check:
         value = -ALPHABETA
-        for ns in next_states:
-            value = max(value, alphabeta(ns, depth - 1, alpha, beta, False))
-            alpha = max(alpha, value)
-            if alpha >= beta: break
-        return value
+        moves = list(generate_moves(state, attacks))
     else:
-        value = ALPHABETA
-        for ns in next_states:
-            value = min(value, alphabeta(ns, depth - 1, alpha, beta, True))
-            beta = min(beta, value)
-            if beta <= alpha: break
-        return value
+        value = stand_pat
+        if value >= beta: return value
+        alpha = max(alpha, value)
+        moves = list(generate_moves(state, attacks, CAPTURE_MOVES))
+    scores = [move_value(board, m) if check else capture_score(board, m) for m in moves]
+
+    for m in pick_best(moves, scores):
+        if not check and stand_pat + capture_gain(board, m) + DELTA_MARGIN <= alpha: 
+            continue
+        ns, undo = make_move(state, m)
+        score = -quiescence(ns, -beta, -alpha, enemy_attacks(ns))
+        unmake_move(ns, undo)
+        value = max(value, score)
+        alpha = max(alpha, value)
+        if alpha >= beta: break
+    return value
+
 
 MOBILITY_SCORE = PIECE_VALUE[P] // 10
 PAWN_PUNISH = PIECE_VALUE[P] // 2
-def evaluate(state: GameState, next_states, depth) -> int:
-    position_value = 0
+BLOCKED_PAWN_PUNISH = PIECE_VALUE[P] // 10
+BACKWARD_PAWN_PUNISH = PIECE_VALUE[P] // 5
+# Bonus of a passed pawn by the ranks it has advanced
+PASSED_PAWN_BONUS = (0, 5, 10, 20, 35, 60)
+PAWN_STEP = {w: -16, b: 16}
+
+def _file_span(square: int, step: int) -> Tuple[int, ...]:
+    """Squares from square on along step, on its file and the adjacent ones"""
+    span: List[int] = []
+    while not square & 0x88:
+        span.extend(s for s in (square - 1, square, square + 1) if not s & 0x88)
+        square += step
+    return tuple(span)
+
+# Squares in front of a pawn no enemy pawn may hold for it to be passed, and
+# the squares beside and behind it where its own pawns could guard its advance
+PASSED_PAWN_SQUARES = {c: [() if square & 0x88 else _file_span(square + PAWN_STEP[c], PAWN_STEP[c])
+                           for square in range(128)] for c in COLOUR}
+SUPPORT_PAWN_SQUARES = {c: [() if square & 0x88 else tuple(
+                                s for s in _file_span(square, -PAWN_STEP[c]) if s & 7 != square & 7)
+                            for square in range(128)] for c in COLOUR}
+
+PAWN_TABLE_SIZE = 1 << 14
+# pawn_zobrist and score_pawns of the last pawn structures seen, by pawn_zobrist
+pawn_table: List[Optional[Tuple[int, int]]] = [None] * PAWN_TABLE_SIZE
+
+
+def pawn_structure(state: GameState) -> int:
+    """score_pawns of state, looked up in pawn_table and only computed on a miss"""
+    index = state.pawn_zobrist & (PAWN_TABLE_SIZE - 1)
+    entry = pawn_table[index]
+    if entry is not None and entry[0] == state.pawn_zobrist:
+        return entry[1]
+    value = score_pawns(state.board, state.piece_squares, state.pawn_files)
+    pawn_table[index] = (state.pawn_zobrist, value)
+    return value
+
+
+def score_pawns(board: board_t, piece_squares: pieces_t, pawn_files: Tuple[int, ...]) -> int:
+    """Pawn structure score from white's view, it depends on the pawns alone"""
+    value = 0
+    for colour, sign in ((w, 1), (b, -1)):
+        files = pawn_files[:8] if colour == w else pawn_files[8:]
+        pawn, enemy_pawn = P | colour, P | colour ^ PLAYER_BITS
+        step = PAWN_STEP[colour]
+
+        # punish doubled pawns
+        value -= sign * sum(i for i in files if i > 1) * PAWN_PUNISH
+
+        # punish isolated pawns
+        for f, count in enumerate(files):
+            if count and not (f > 0 and files[f - 1] or f < 7 and files[f + 1]):
+                value -= sign * count * PAWN_PUNISH
+
+        for square in piece_squares[colour]:
+            if board[square] != pawn: continue
+            # punish pawns blocked by a pawn, pieces in front come and go
+            if board[square + step] & P:
+                value -= sign * BLOCKED_PAWN_PUNISH
+            # revard passed pawns, punish backward ones
+            if not any(board[s] == enemy_pawn for s in PASSED_PAWN_SQUARES[colour][square]):
+                rank = square >> 4
+                value += sign * PASSED_PAWN_BONUS[6 - rank if colour == w else rank - 1]
+            elif (not any(board[s] == pawn for s in SUPPORT_PAWN_SQUARES[colour][square])
+                    and any(board[s] == enemy_pawn 
+                            for s in PAWN_ATTACKER_SQUARES[colour ^ PLAYER_BITS][square + step])):
+                value -= sign * BACKWARD_PAWN_PUNISH
+    return value
+
+
+def static_evaluation(state: GameState) -> int:
+    """evaluate without mobility, of any position from white's view"""
+    # Tapered between the middlegame and endgame scores, promotions can take 
+    # the phase past its starting value
+    phase = min(state.phase, MAX_PHASE)
+    return ((state.score * phase + state.endgame_score * (MAX_PHASE - phase)) // MAX_PHASE
+            + pawn_structure(state))
+
+
+def evaluate(state: GameState, num_moves: int, depth: int) -> int:
     other_player = state.player ^ PLAYER_BITS
-    white_pawn_files = [0] * 8
-    black_pawn_files = [0] * 8
-    if len(next_states) == 0:
-        king_square = 0
-        for square in range(128):
-            if square & 0x88: continue 
-            piece = state.board[square]
-            if piece & K and piece & state.player: 
-                king_square = square
-                break
-        
-        # check by night.
-        for m in MOVE_VECTORS[wN]:
-            if king_square + m & 0x88: continue
-            nightmove = state.board[king_square + m]
-            if nightmove & N and nightmove & other_player:
-                return MATE * (-1 if state.player == w else 1) * depth
-        
-        for dir_one, dir_two in ((north+west, south+east), 
-                                 (north+east, south+west),
-                                 (north, south), 
-                                 (east, west),
-                                 (south+east, north+west), 
-                                 (south+west, north+east),
-                                 (south, north), 
-                                 (west, east)):
-            att_sqr = king_square
-            while True:
-                att_sqr += dir_one
-                if att_sqr & 0x88: break 
-                piece = state.board[att_sqr]
-                if piece & state.player: break
-                if piece & other_player:
-                    if piece & P: 
-                        if dir_one in (north, south, east, west): break
-                        if dir_two in MOVE_VECTORS[piece] and dir_two + att_sqr == king_square:
-                            return MATE * (-1 if state.player == w else 1)  * depth
-                    if piece & N: break
-                    if piece & K: break
-                    if dir_two in MOVE_VECTORS[piece]:
-                        return MATE * (-1 if state.player == w else 1)  * depth
+    if num_moves == 0:
+        king_square = state.kings[0 if state.player & w else 1]
+        if attacked(state.board, king_square, other_player):
+            return MATE * (-1 if state.player == w else 1) * (depth + 1)
         # not mate
         return 0                  
 
-    for square in range(128):
-        if square & 0x88: continue 
-        piece = state.board[square]
-        if piece == 0: continue
-        if piece & P:
-            if piece & w:
-                white_pawn_files[square & 0b111] += 1
-            else:
-                black_pawn_files[square & 0b111] += 1
-        position_value += PIECE_SQUARE_VALUE[piece][square]
-
-    # punish doubled pawns
-    position_value -= sum(i for i in white_pawn_files if i > 1) * PAWN_PUNISH
-    position_value += sum(i for i in black_pawn_files if i > 1) * PAWN_PUNISH
-
-    # punish isolated pawns
-    if white_pawn_files[0] > 0 and white_pawn_files[1] == 0:
-        position_value -= white_pawn_files[0] * PAWN_PUNISH
-    if black_pawn_files[0] > 0 and black_pawn_files[1] == 0:
-        position_value += black_pawn_files[0] * PAWN_PUNISH
-    if white_pawn_files[7] > 0 and white_pawn_files[6] == 0:
-        position_value -= white_pawn_files[7] * PAWN_PUNISH
-    if black_pawn_files[7] > 0 and black_pawn_files[6] == 0:
-        position_value += black_pawn_files[7] * PAWN_PUNISH
-    for i, j, k in zip(white_pawn_files, white_pawn_files[1:], white_pawn_files[2:]):
-        if i == 0 and j > 0 and k == 0:
-            position_value += i * PAWN_PUNISH
-    for i, j, k in zip(black_pawn_files, black_pawn_files[1:], black_pawn_files[2:]):
-        if i == 0 and j > 0 and k == 0:
-            position_value += i * PAWN_PUNISH
-
-    # punish blocked pawns
+    position_value = static_evaluation(state)
 
     # revard mobility
-    position_value += len(next_states) * MOBILITY_SCORE * (
+    position_value += num_moves * MOBILITY_SCORE * (
         -1 if state.player & b else 1)
     other_side = state._replace(player=state.player^PLAYER_BITS)
-    position_value += len(move_generation(other_side).values()) * MOBILITY_SCORE * (
+    position_value += count_moves(other_side, enemy_attacks(other_side)) * MOBILITY_SCORE * (
         1 if state.player & b else -1)
     return position_value
 
@@ -649,9 +1573,70 @@ def parse_FEN(fen_string: str) -> GameState:
             castle_bin |= bOO
         if "q" in castle and parsed_board[0] == bR:
             castle_bin |= bOOO
-        
-    return GameState(parsed_board, w if player == "w" else b, 
-                 castle_bin, ep_square, pawnmove, num_moves, 0, 0, 0, 0)
+
+    return game_state(parsed_board, w if player == "w" else b, 
+                      castle_bin, ep_square, pawnmove, num_moves)
+
+
+def game_state(board: board_t, player: int, castle: int, ep: int, 
+               pawnmove: int, num_moves: int) -> GameState:
+    """GameState for a board, with the incrementally updated fields computed from scratch"""
+    piece_squares: pieces_t = {w: set(), b: set()}
+    kings = [OFF_THE_BOARD, OFF_THE_BOARD]
+    for square, piece in enumerate(board):
+        if piece:
+            piece_squares[piece & PLAYER_BITS].add(square)
+            if piece & K:
+                kings[0 if piece & w else 1] = square
+
+    state = GameState(board, player, castle, ep, pawnmove, num_moves, 0, 0, 0, 0, 0, 
+                      board_score(board), board_score(board, PIECE_SQUARE_VALUE_ENDGAME), 
+                      board_phase(board), count_pawn_files(board), pawn_hash(board), 
+                      piece_squares, (kings[0], kings[1]))
+    return state._replace(zobrist=zobrist_hash(state))
+
+
+def board_score(board: board_t, values: Dict[int, Tuple[int, ...]] = PIECE_SQUARE_VALUE) -> int:
+    return sum(values[board[square]][square] 
+               for square in range(128) if not square & 0x88)
+
+
+def board_phase(board: board_t) -> int:
+    return sum(GAME_PHASE[board[square]] for square in range(128) if not square & 0x88)
+
+
+def pawn_file(pawn: int, square: int) -> int:
+    """Index of the pawn's file in GameState.pawn_files"""
+    return (square & 0b111) | (8 if pawn & b else 0)
+
+
+def count_pawn_files(board: board_t) -> Tuple[int, ...]:
+    pawn_files = [0] * 16
+    for square in range(128):
+        if square & 0x88: continue 
+        piece = board[square]
+        if piece & P:
+            pawn_files[pawn_file(piece, square)] += 1
+    return tuple(pawn_files)
+
+
+def pawn_hash(board: board_t) -> int:
+    zobrist = 0
+    for square in range(128):
+        if square & 0x88: continue 
+        if board[square] & P:
+            zobrist ^= ZOBRIST_PIECE[board[square]][square]
+    return zobrist
+
+
+def zobrist_hash(state: GameState) -> int:
+    zobrist = ZOBRIST_CASTLE[state.castle] ^ ZOBRIST_EP[state.ep]
+    if state.player & b:
+        zobrist ^= ZOBRIST_BLACK
+    for square in range(128):
+        if square & 0x88: continue 
+        zobrist ^= ZOBRIST_PIECE[state.board[square]][square]
+    return zobrist
 
 
 def to_fen(state: GameState) -> str:
@@ -688,22 +1673,52 @@ def to_fen(state: GameState) -> str:
     return "".join(string_builder)
 
 
-def parse_move_input(move: str) -> Tuple[int, ...]:
+# Packed positions: 32 bytes with a nibble per square, a8 in the low nibble of 
+# the first byte, followed by player, castle, ep square and the two clocks
+PIECE_NIBBLE = {piece: PIECE_TYPES.index(piece & ~PLAYER_BITS) + (1 if piece & w else 9)
+                for piece in PIECES}
+PIECE_NIBBLE[0] = 0
+NIBBLE_PIECE = [0] * 16
+for _piece, _nibble in PIECE_NIBBLE.items():
+    NIBBLE_PIECE[_nibble] = _piece
+# Pieces on the two squares of a packed byte
+BYTE_PIECES = [(NIBBLE_PIECE[i & 0xF], NIBBLE_PIECE[i >> 4]) for i in range(256)]
+SQUARES = [square for square in range(128) if not square & 0x88]
+POSITION_HEADER = struct.Struct("<BBBHH")
+POSITION_BYTES = 32 + POSITION_HEADER.size
+
+
+def encode_position(state: GameState) -> bytes:
+    board = state.board
+    pieces = bytes(PIECE_NIBBLE[board[SQUARES[i]]] | PIECE_NIBBLE[board[SQUARES[i + 1]]] << 4 
+                   for i in range(0, 64, 2))
+    return pieces + POSITION_HEADER.pack(state.player, state.castle, state.ep, 
+                                         state.pawnmove, state.num_moves)
+
+
+def decode_position(buffer, offset: int = 0) -> GameState:
+    """GameState of the packed position at offset in a bytes, bytearray or memoryview"""
+    board = [0] * 128
+    for i in range(32):
+        square = SQUARES[2 * i]
+        board[square], board[square + 1] = BYTE_PIECES[buffer[offset + i]]
+    player, castle, ep, pawnmove, num_moves = POSITION_HEADER.unpack_from(buffer, offset + 32)
+    return game_state(board, player, castle, ep, pawnmove, num_moves)
+
+
+def parse_move_input(move: str) -> int:
+    """The move's key bits (see MOVE_KEY_MASK), -1 if move can not be parsed"""
     match = re.match("^([a-hA-H][1-8])([a-hA-H][1-8])([QRBNqrbn])?$", move.replace(" ", ""))
     if not match:
-        return OFF_THE_BOARD, OFF_THE_BOARD
+        return -1
     f, t = match.group(1,2)
-    try:
-        if match.group(3):
-            return (BOARD_NOTATION.index(f.lower()), 
-                    BOARD_NOTATION.index(t.lower()),
-                    PROMOTE_PIECE[match.group(3)])
-        else:
-            return (BOARD_NOTATION.index(f.lower()), BOARD_NOTATION.index(t.lower()))
-    except ValueError:
-        return (OFF_THE_BOARD, OFF_THE_BOARD)
+    key = BOARD_NOTATION.index(f.lower()) | BOARD_NOTATION.index(t.lower()) << 7
+    if match.group(3):
+        key |= PROMOTE_PIECE[match.group(3)] << PROMOTE_SHIFT
+    return key
 
 
+MAIN_MOVETIME = 15_000
 def main(state: GameState) -> None:
     while True:
         draw_board(state.board)
@@ -713,7 +1728,7 @@ def main(state: GameState) -> None:
             break
 
         while True:
-            move = parse_move_input(input("Enter move: "))
+            move = uci_to_move(state, input("Enter move: "))
             if move in moves:
                 state = moves[move]
                 break
@@ -721,10 +1736,11 @@ def main(state: GameState) -> None:
                 print("Enter moves in from to square form. eg. e2e4, promotion append q b r n eg. e7e8q")
         draw_board(state.board)
         
-        state = search(state, 6, print_status=True)
-        if not state:
+        move, _ = iterative_deepening(state, 6, movetime=MAIN_MOVETIME, print_status=True)
+        if move is None:
             print("You win :-)")
             break
+        state = generate_new_state(state, *decode_move(move))
 
 if __name__ == "__main__":
     import sys
@@ -732,5 +1748,7 @@ if __name__ == "__main__":
         fen = sys.argv[1]
     else:
         fen = STARTING_FEN
+    if len(sys.argv) > 2:
+        search_options = SearchOptions(workers=int(sys.argv[2]))
     state = parse_FEN(fen)
     main(state)
\ No newline at end of file
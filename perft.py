@@ -1,49 +1,114 @@
 #!/bin/pypy3
+import argparse
+import multiprocessing
+from types import ModuleType
+from typing import Dict, Tuple
+
 import chessy
 
+# Subtree counts keyed by position and depth, cleared when full
+PERFT_HASH_ENTRIES = 1 << 20
+perft_hash: Dict[Tuple, int] = {}
+
 
-def num_moves(state, num_iterations):
+def num_moves(state, num_iterations, use_hash=False):
     if num_iterations <= 0:
         return 1
+    attacks = chessy.enemy_attacks(state)
     if num_iterations == 1:
-        return len(chessy.move_generation(state).values())
+        return chessy.count_moves(state, attacks)
+    if use_hash:
+        key = (state.zobrist, num_iterations)
+        if key in perft_hash:
+            return perft_hash[key]
+    moves = chessy.generate_moves(state, attacks)
     num = 0
-    for s in chessy.move_generation(state).values():
-        num += num_moves(s, num_iterations - 1)
+    for m in moves:
+        s, undo = chessy.make_move(state, m)
+        num += num_moves(s, num_iterations - 1, use_hash)
+        chessy.unmake_move(s, undo)
+    if use_hash:
+        store_count(key, num)
     return num
 
 
-def perft(depth, fenstring, movelist):
-    state = chessy.parse_FEN(fenstring)
+def bitboard_num_moves(state, num_iterations, use_hash=False):
+    # Building the bitboard tables takes a while, so only when they are used
+    import bitboard
+    return count_bitboard_moves(bitboard, state, num_iterations, use_hash)
+
+
+def count_bitboard_moves(bitboard, state, num_iterations, use_hash=False):
+    if num_iterations <= 0:
+        return 1
+    moves = bitboard.legal_moves(state)
+    if num_iterations == 1:
+        return len(moves)
+    if use_hash:
+        key = (state.bitboards, state.player, state.castle, state.ep, num_iterations)
+        if key in perft_hash:
+            return perft_hash[key]
+    num = sum(count_bitboard_moves(bitboard, bitboard.make_move(state, m), num_iterations - 1, use_hash)
+              for m in moves)
+    if use_hash:
+        store_count(key, num)
+    return num
+
+
+def store_count(key, num):
+    if len(perft_hash) >= PERFT_HASH_ENTRIES:
+        perft_hash.clear()
+    perft_hash[key] = num
+
+
+def count_subtree(job):
+    """Worker for the process pool, counts the nodes below one root move"""
+    use_bitboard, state, depth, use_hash = job
+    count = bitboard_num_moves if use_bitboard else num_moves
+    return count(state, depth, use_hash)
+
+
+def perft(depth, fenstring, movelist, backend=chessy, jobs=1, use_hash=False):
+    state = backend.parse_FEN(fenstring)
     if movelist:
         for m in movelist:
-            move = chessy.parse_move_input(m)
-            moves = chessy.move_generation(state)
-            state = moves[move]
-    total = 0
-    for m, s in chessy.move_generation(state).items():
-        f,t,*p = m
-        print(chessy.BOARD_NOTATION[f] + chessy.BOARD_NOTATION[t], end="")
-        if p:
-            print(chessy.PROMOTE_PIECE_ENCODING[p[0]], end="")
-        moves = num_moves(s, depth - 1)
-        total += moves
-        print(f" {moves}")
-    print(f"\n{total}")
+            state = backend.move_generation(state)[backend.uci_to_move(state, m)]
+    children = backend.move_generation(state)
+    subtrees = [(backend is not chessy, s, depth - 1, use_hash) for s in children.values()]
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        counts = pool.imap(count_subtree, subtrees) if pool else map(count_subtree, subtrees)
+        total = 0
+        for m, moves in zip(children, counts):
+            total += moves
+            print(f"{backend.move_to_uci(m)} {moves}")
+        print(f"\n{total}")
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return total
 
 
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) < 2 or not sys.argv[1].isdigit():
-        print("Usage is: python perft.py <depth> [<FEN string>] [<movelist>]")
-        exit(1)
-    try:
-        fen = sys.argv[2]
-    except IndexError:
-        fen = chessy.STARTING_FEN
-
-    movelist = None
-    if len(sys.argv) == 4 and sys.argv[3]:
-        movelist = sys.argv[3].split()
+    parser = argparse.ArgumentParser(
+        description="Count the leaf nodes of the move tree, divided by root move")
+    parser.add_argument("depth", type=int)
+    parser.add_argument("fen", nargs="?", default=chessy.STARTING_FEN)
+    parser.add_argument("movelist", nargs="?", default="",
+                        help="space separated moves played from the FEN")
+    parser.add_argument("--bitboard", action="store_true",
+                        help="count with the bitboard backend")
+    parser.add_argument("--hash", action="store_true",
+                        help="reuse counts of transposed positions")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of processes to split the root moves over")
+    args = parser.parse_args()
 
-    perft(int(sys.argv[1]), fenstring=fen, movelist=movelist)
\ No newline at end of file
+    backend: ModuleType = chessy
+    if args.bitboard:
+        import bitboard
+        backend = bitboard
+    perft(args.depth, fenstring=args.fen, movelist=args.movelist.split(),
+          backend=backend,
+          jobs=args.jobs, use_hash=args.hash)
@@ -0,0 +1,393 @@
+#!/bin/pypy3
+"""
+Endgame tablebases for positions with few pieces, built by retrograde
+analysis. A table holds one byte per position of its material: 0 for a
+draw or an illegal position, otherwise the plies to mate plus one, so odd
+when the side to move is mated and even when it mates. The tables of a
+file are memory-mapped and probed in place.
+
+Positions are indexed by the side to move and the squares of the pieces,
+white king first. The board is mirrored so the white king is on files a-d,
+and the side with more material is always white. En passant and castling
+are left out, so tables with pawns on both sides are not built.
+"""
+import argparse
+import mmap
+import os
+import struct
+from collections import defaultdict
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple, Union
+
+import chessy
+from chessy import w, b, P, R, N, B, Q, K, PLAYER_BITS
+
+PIECE_LETTERS = "KQRBNP"
+LETTER_PIECE = {"K": K, "Q": Q, "R": R, "B": B, "N": N, "P": P}
+PIECE_LETTER = {piece: letter for letter, piece in LETTER_PIECE.items()}
+PROMOTIONS = [Q, R, B, N]
+# Material that cannot mate, every position is a draw
+DRAWN = {"KK", "KBK", "KNK"}
+DEFAULT_TABLES = ["KQK", "KRK", "KPK"]
+# Scores of won positions, above any evaluation but below the mate scores
+TB_WIN = chessy.MATE // 2
+
+FILE_HEADER = struct.Struct("<4sI")
+TABLE_HEADER = struct.Struct("<8sQ")
+MAGIC = b"CTB1"
+
+# 64 square tables, a8 = 0 to h1 = 63 like chessy.SQUARES
+SQUARE_INDEX = {square: i for i, square in enumerate(chessy.SQUARES)}
+def _squares(table: List[Tuple[int, ...]]) -> List[Tuple[int, ...]]:
+    return [tuple(SQUARE_INDEX[t] for t in table[square]) for square in chessy.SQUARES]
+KING_TARGETS = _squares(chessy.KING_SQUARES)
+KNIGHT_TARGETS = _squares(chessy.KNIGHT_SQUARES)
+RAYS = [tuple((tuple(SQUARE_INDEX[t] for t in ray), sliders) for ray, sliders in chessy.RAYS[square])
+        for square in chessy.SQUARES]
+# Squares a pawn of each colour on a square attacks
+PAWN_TARGETS = {c: [tuple(t for t in range(64) if s in attackers[t]) for s in range(64)]
+                for c, attackers in zip(chessy.COLOUR, map(_squares,
+                    (chessy.PAWN_ATTACKER_SQUARES[c] for c in chessy.COLOUR)))}
+PAWN_STEP = {w: -8, b: 8}
+PAWN_START_RANK = {w: 6, b: 1}
+PAWN_LAST_RANK = {w: 0, b: 7}
+
+# A piece list is [(piece, square)], squares of 64
+pieces_t = List[Tuple[int, int]]
+# A table as built or as mapped from a file
+table_t = Union[bytes, bytearray, memoryview]
+
+
+def side_value(letters: str) -> Tuple[int, str]:
+    return sum(chessy.PIECE_VALUE[LETTER_PIECE[c]] for c in letters), letters
+
+
+def split_name(name: str) -> Tuple[str, str]:
+    """White and black pieces of a material name like KRK"""
+    black = name.index("K", 1)
+    return name[:black], name[black:]
+
+
+def canonical_name(name: str) -> str:
+    white, black = ("K" + "".join(sorted(side[1:], key=PIECE_LETTERS.index))
+                    for side in split_name(name.upper()))
+    if side_value(black) > side_value(white):
+        white, black = black, white
+    return white + black
+
+
+def table_position(pieces: pieces_t, stm: int) -> Tuple[str, int]:
+    """Table name and index of pieces with stm, 0 for white and 1 for black, to move"""
+    order = lambda p: PIECE_LETTERS.index(PIECE_LETTER[p[0] & ~PLAYER_BITS])
+    white = sorted((p for p in pieces if p[0] & w), key=order)
+    black = sorted((p for p in pieces if p[0] & b), key=order)
+    white_letters = "".join(PIECE_LETTER[p & ~PLAYER_BITS] for p, _ in white)
+    black_letters = "".join(PIECE_LETTER[p & ~PLAYER_BITS] for p, _ in black)
+    if side_value(black_letters) > side_value(white_letters):
+        white, black = [(p, s ^ 56) for p, s in black], [(p, s ^ 56) for p, s in white]
+        white_letters, black_letters = black_letters, white_letters
+        stm ^= 1
+    return white_letters + black_letters, encode(stm, [s for _, s in white + black])
+
+
+def encode(stm: int, squares: List[int]) -> int:
+    if squares[0] & 7 > 3:
+        squares = [s ^ 7 for s in squares]
+    king = squares[0]
+    index = stm << 5 | (king >> 3) << 2 | (king & 7)
+    for s in squares[1:]:
+        index = index << 6 | s
+    return index
+
+
+def decode(index: int, num_pieces: int) -> Tuple[int, List[int]]:
+    squares = []
+    for _ in range(num_pieces - 1):
+        squares.append(index & 0x3f)
+        index >>= 6
+    squares.append((index >> 2 & 7) << 3 | (index & 3))
+    squares.reverse()
+    return index >> 5, squares
+
+
+def table_pieces(name: str) -> List[int]:
+    white, black = split_name(name)
+    return [LETTER_PIECE[c] | w for c in white] + [LETTER_PIECE[c] | b for c in black]
+
+
+def king_attacked(pieces: pieces_t, colour: int) -> bool:
+    """Whether the king of colour is attacked, board built from the piece list"""
+    board = [0] * 128
+    for piece, square in pieces:
+        board[chessy.SQUARES[square]] = piece
+    king = next(chessy.SQUARES[square] for piece, square in pieces if piece == K | colour)
+    return chessy.attacked(board, king, colour ^ PLAYER_BITS)
+
+
+def is_legal(pieces: pieces_t, stm: int) -> bool:
+    if len({s for _, s in pieces}) < len(pieces):
+        return False
+    if any(p & P and s >> 3 in (0, 7) for p, s in pieces):
+        return False
+    # The side not to move cannot be in check
+    return not king_attacked(pieces, b if stm == 0 else w)
+
+
+def piece_moves(pieces: pieces_t, occupied: Dict[int, int], i: int
+                ) -> Iterator[Tuple[int, Optional[int], int]]:
+    """Pseudo legal to square, captured piece index and promotion of piece i"""
+    piece, square = pieces[i]
+    colour, kind = piece & PLAYER_BITS, piece & ~PLAYER_BITS
+    if kind == P:
+        step = PAWN_STEP[colour]
+        promote = square + step >> 3 == PAWN_LAST_RANK[colour]
+        targets = [square + step] if square + step not in occupied else []
+        if targets and square >> 3 == PAWN_START_RANK[colour] and square + 2 * step not in occupied:
+            targets.append(square + 2 * step)
+        targets.extend(t for t in PAWN_TARGETS[colour][square]
+                       if t in occupied and not pieces[occupied[t]][0] & colour)
+        for t in targets:
+            for promotion in PROMOTIONS if promote else [0]:
+                yield t, occupied.get(t), promotion
+        return
+    if kind in (K, N):
+        for t in KING_TARGETS[square] if kind == K else KNIGHT_TARGETS[square]:
+            j = occupied.get(t)
+            if j is None or not pieces[j][0] & colour:
+                yield t, j, 0
+        return
+    for ray, sliders in RAYS[square]:
+        if not kind & sliders: continue
+        for t in ray:
+            j = occupied.get(t)
+            if j is None:
+                yield t, None, 0
+                continue
+            if not pieces[j][0] & colour:
+                yield t, j, 0
+            break
+
+
+def piece_unmoves(pieces: pieces_t, occupied: Dict[int, int], i: int) -> Iterator[int]:
+    """Squares piece i could have come from with a move that neither captured nor promoted"""
+    piece, square = pieces[i]
+    colour, kind = piece & PLAYER_BITS, piece & ~PLAYER_BITS
+    if kind == P:
+        step = PAWN_STEP[colour]
+        start = PAWN_START_RANK[colour]
+        origin = square - step
+        if origin in occupied or origin >> 3 == PAWN_LAST_RANK[colour ^ PLAYER_BITS]:
+            return
+        yield origin
+        if origin >> 3 == start + step // 8 and origin - step not in occupied:
+            yield origin - step
+        return
+    if kind in (K, N):
+        targets = KING_TARGETS[square] if kind == K else KNIGHT_TARGETS[square]
+        yield from (t for t in targets if t not in occupied)
+        return
+    for ray, sliders in RAYS[square]:
+        if not kind & sliders: continue
+        for t in ray:
+            if t in occupied: break
+            yield t
+
+
+def children(name: str) -> List[str]:
+    """Materials a capture or promotion leads to from name"""
+    names = set()
+    white, black = split_name(name)
+    for i, c in enumerate(white[1:], 1):
+        names.add(white[:i] + white[i + 1:] + black)
+        if c == "P":
+            names.update(white[:i] + PIECE_LETTER[p] + white[i + 1:] + black for p in PROMOTIONS)
+    for i, c in enumerate(black[1:], 1):
+        names.add(white + black[:i] + black[i + 1:])
+        if c == "P":
+            names.update(white + black[:i] + PIECE_LETTER[p] + black[i + 1:] for p in PROMOTIONS)
+    return sorted(canonical_name(n) for n in names)
+
+
+def probe_tables(tables: Mapping[str, table_t], pieces: pieces_t, stm: int) -> Optional[int]:
+    name, index = table_position(pieces, stm)
+    if name in DRAWN:
+        return 0
+    table = tables.get(name)
+    return None if table is None else table[index]
+
+
+def generate(name: str, tables: Mapping[str, table_t]) -> bytearray:
+    """
+    Retrograde analysis of a material, the tables of its captures and
+    promotions must be in tables. Mates are found first, then positions one
+    ply further away from the positions decided the ply before, going back
+    along unmoves. A position is lost once every move is known to lose.
+    """
+    white, black = split_name(name)
+    if "P" in white and "P" in black:
+        raise ValueError(f"{name}: pawns on both sides need en passant")
+    codes = table_pieces(name)
+    num_pieces = len(codes)
+    size = 64 << 6 * (num_pieces - 1)
+    values = bytearray(size)
+    legal = bytearray(size)
+    for index in range(size):
+        stm, squares = decode(index, num_pieces)
+        if encode(stm, squares) == index and is_legal(list(zip(codes, squares)), stm):
+            legal[index] = 1
+
+    # Moves that are not yet known to lose, plus one if some move does not
+    # lose, and the ply of the slowest loss by capture or promotion
+    moves_left = bytearray(size)
+    exit_loss = bytearray(size)
+    pending: Dict[int, List[int]] = defaultdict(list)
+    for index in range(size):
+        if not legal[index]: continue
+        stm, squares = decode(index, num_pieces)
+        pieces = list(zip(codes, squares))
+        occupied = {s: i for i, s in enumerate(squares)}
+        colour = w if stm == 0 else b
+        in_table = 0
+        win = 0
+        safe = False
+        for i, (piece, square) in enumerate(pieces):
+            if not piece & colour: continue
+            for to, captured, promotion in piece_moves(pieces, occupied, i):
+                if captured is None and not promotion:
+                    child = squares[:i] + [to] + squares[i + 1:]
+                    in_table += legal[encode(stm ^ 1, child)]
+                    continue
+                child_pieces = [(promotion | colour if j == i and promotion else p, to if j == i else s)
+                                for j, (p, s) in enumerate(pieces) if j != captured]
+                if king_attacked(child_pieces, colour): continue
+                value = probe_tables(tables, child_pieces, stm ^ 1)
+                if value is None:
+                    raise ValueError(f"{name}: missing table for {table_position(child_pieces, 0)[0]}")
+                if value == 0:
+                    safe = True
+                elif value % 2:
+                    win = min(win, value) if win else value
+                else:
+                    exit_loss[index] = max(exit_loss[index], value)
+        if win:
+            pending[win].append(index)
+        moves_left[index] = in_table + (safe or bool(win))
+        if not moves_left[index]:
+            if exit_loss[index]:
+                pending[exit_loss[index]].append(index)
+            elif king_attacked(pieces, colour):
+                pending[0].append(index)
+
+    ply = 0
+    while any(p >= ply for p in pending):
+        for index in pending.pop(ply, []):
+            if values[index]: continue
+            if ply >= 255:
+                raise ValueError(f"{name}: mates beyond 254 plies do not fit a byte")
+            values[index] = ply + 1
+            stm, squares = decode(index, num_pieces)
+            pieces = list(zip(codes, squares))
+            occupied = {s: i for i, s in enumerate(squares)}
+            mover = b if stm == 0 else w
+            for i, (piece, square) in enumerate(pieces):
+                if not piece & mover: continue
+                for origin in piece_unmoves(pieces, occupied, i):
+                    parent = encode(stm ^ 1, squares[:i] + [origin] + squares[i + 1:])
+                    if not legal[parent] or values[parent]: continue
+                    if ply % 2 == 0:
+                        pending[ply + 1].append(parent)
+                    else:
+                        moves_left[parent] -= 1
+                        if not moves_left[parent]:
+                            pending[max(ply + 1, exit_loss[parent])].append(parent)
+        ply += 1
+    return values
+
+
+def build(names: List[str]) -> Dict[str, bytearray]:
+    """The tables of names and of everything they lead to"""
+    tables: Dict[str, bytearray] = {}
+    def add(name: str) -> None:
+        if name in tables or name in DRAWN: return
+        for child in children(name):
+            add(child)
+        tables[name] = generate(name, tables)
+    for name in names:
+        add(canonical_name(name))
+    return tables
+
+
+def write_tables(path: str, tables: Dict[str, bytearray]) -> None:
+    offset = FILE_HEADER.size + TABLE_HEADER.size * len(tables)
+    with open(path, "wb") as f:
+        f.write(FILE_HEADER.pack(MAGIC, len(tables)))
+        for name, table in tables.items():
+            f.write(TABLE_HEADER.pack(name.encode(), offset))
+            offset += len(table)
+        for table in tables.values():
+            f.write(table)
+
+
+class Tablebase:
+    """Tables of a file written by write_tables, memory-mapped"""
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = FILE_HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a tablebase file")
+        self.tables: Dict[str, memoryview] = {}
+        view = memoryview(self.data)
+        for i in range(count):
+            name, offset = TABLE_HEADER.unpack_from(self.data, FILE_HEADER.size + i * TABLE_HEADER.size)
+            name = name.rstrip(b"\0").decode()
+            self.tables[name] = view[offset:offset + (64 << 6 * (len(name) - 1))]
+        self.max_pieces = max(map(len, self.tables), default=0)
+
+    def close(self) -> None:
+        self.tables.clear()
+        self.data.close()
+
+    def probe(self, state: chessy.GameState) -> Optional[int]:
+        """Table value of state, None if it has no table"""
+        if state.castle:
+            return None
+        board = state.board
+        pieces = [(board[s], SQUARE_INDEX[s]) for c in chessy.COLOUR for s in state.piece_squares[c]]
+        if len(pieces) > self.max_pieces:
+            return None
+        return probe_tables(self.tables, pieces, 0 if state.player & w else 1)
+
+    def probe_score(self, state: chessy.GameState) -> Optional[int]:
+        """Score of state from the side to move, faster mates scoring higher"""
+        value = self.probe(state)
+        if not value:
+            return value
+        return TB_WIN - value if value % 2 == 0 else value - TB_WIN
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or probe endgame tablebases")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_command = commands.add_parser("build", help="generate tables into a file")
+    build_command.add_argument("file")
+    build_command.add_argument("tables", nargs="*", default=DEFAULT_TABLES,
+                               help="materials like KQK, tables they lead to are added")
+    probe_command = commands.add_parser("probe", help="look a position up")
+    probe_command.add_argument("file")
+    probe_command.add_argument("fen")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        tables = build(args.tables)
+        write_tables(args.file, tables)
+        print(" ".join(tables), os.path.getsize(args.file), "bytes")
+    else:
+        tablebase = Tablebase(args.file)
+        value = tablebase.probe(chessy.parse_FEN(args.fen))
+        if value is None:
+            print("not in the tables")
+        elif value == 0:
+            print("draw")
+        else:
+            print(f"{'win' if value % 2 == 0 else 'loss'} in {value - 1} plies")
+        tablebase.close()
@@ -1,9 +1,23 @@
 #!/bin/pypy3
+import contextlib
+import io
 import json
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 
+import batch
+import bitboard
+import book
 import chessy
 import perft
+import tablebase
+import uci
+import vector_eval
 
 
 class TestChessy(unittest.TestCase):
@@ -24,7 +38,442 @@ class TestChessy(unittest.TestCase):
                 else:
                     print("Success!\n")
                 self.assertEqual(perft_result, pos["nodes"])
-    
+
+    def test_bitboard_perft_positions(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        for pos in positions:
+            if not pos["type"] == "perf_test": continue
+            with self.subTest(pos=pos):
+                state = bitboard.parse_FEN(pos["fen"])
+                self.assertEqual(bitboard.to_fen(state),
+                                 chessy.to_fen(chessy.parse_FEN(pos["fen"])))
+                perft_result = perft.bitboard_num_moves(state, pos["depth"])
+                self.assertEqual(perft_result, pos["nodes"])
+
+    def test_perft_hash_and_jobs(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        for pos in positions:
+            if not pos["type"] == "perf_test" or pos["nodes"] > 100_000: continue
+            for backend in (chessy, bitboard):
+                with self.subTest(pos=pos, backend=backend.__name__):
+                    perft.perft_hash.clear()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        total = perft.perft(pos["depth"], pos["fen"], None,
+                                            backend=backend, jobs=2, use_hash=True)
+                    self.assertEqual(total, pos["nodes"])
+
+    def test_make_unmake_move(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        for pos in positions:
+            if not pos["type"] == "perf_test": continue
+            with self.subTest(pos=pos):
+                state = chessy.parse_FEN(pos["fen"])
+                board = [*state.board]
+                pieces = {c: {*p} for c, p in state.piece_squares.items()}
+                for m in chessy.legal_moves(state):
+                    child, undo = chessy.make_move(state, m)
+                    expected = chessy.generate_new_state(
+                        state._replace(board=board, piece_squares=pieces), *chessy.decode_move(m))
+                    self.assertEqual(child, expected)
+                    chessy.unmake_move(child, undo)
+                    self.assertEqual(state.board, board)
+                    self.assertEqual(state.piece_squares, pieces)
+
+    def test_staged_moves(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        for pos in positions:
+            if not pos["type"] == "perf_test": continue
+            with self.subTest(pos=pos):
+                state = chessy.parse_FEN(pos["fen"])
+                attacks = chessy.enemy_attacks(state)
+                staged = [m for stage in chessy.MOVE_STAGES 
+                          for m in chessy.generate_moves(state, attacks, stage)]
+                self.assertCountEqual(staged, chessy.legal_moves(state))
+                moves = [chessy.decode_move(m) for m in staged]
+                quiet = [m[5] == 0 and m[2] == chessy.OFF_THE_BOARD and not state.board[m[1]] 
+                         for m in moves]
+                self.assertEqual(quiet, sorted(quiet))
+                for hash_move in staged[:1] + staged[-1:]:
+                    ordered = list(chessy.ordered_moves(state, attacks, hash_move))
+                    self.assertEqual(ordered[0], hash_move)
+                    self.assertCountEqual(ordered, staged)
+
+    def test_incremental_updates(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        for pos in positions:
+            if not pos["type"] == "perf_test": continue
+            with self.subTest(pos=pos):
+                state = chessy.parse_FEN(pos["fen"])
+                for s in chessy.move_generation(state).values():
+                    for ns in [s, *chessy.move_generation(s).values()]:
+                        self.assertEqual(ns.zobrist, chessy.zobrist_hash(ns))
+                        self.assertEqual(ns.score, chessy.board_score(ns.board))
+                        self.assertEqual(ns.endgame_score, chessy.board_score(
+                            ns.board, chessy.PIECE_SQUARE_VALUE_ENDGAME))
+                        self.assertEqual(ns.phase, chessy.board_phase(ns.board))
+                        self.assertEqual(ns.pawn_zobrist, chessy.pawn_hash(ns.board))
+                        self.assertEqual(ns.pawn_files, chessy.count_pawn_files(ns.board))
+                        self.assertEqual(ns.piece_squares, chessy.parse_FEN(chessy.to_fen(ns)).piece_squares)
+                        self.assertEqual(ns.kings, chessy.parse_FEN(chessy.to_fen(ns)).kings)
+
+    def test_tapered_evaluation(self):
+        start = chessy.parse_FEN(chessy.STARTING_FEN)
+        self.assertEqual(start.phase, chessy.MAX_PHASE)
+        self.assertEqual(chessy.evaluate(start, 20, 1), 0)
+        # Without pieces the king belongs in the centre rather than the corner
+        centre = chessy.parse_FEN("k7/8/8/8/3K4/8/8/8 w - - 0 1")
+        corner = chessy.parse_FEN("k7/8/8/8/8/8/8/7K w - - 0 1")
+        self.assertEqual(centre.phase, 0)
+        self.assertGreater(chessy.evaluate(centre, 1, 1), chessy.evaluate(corner, 1, 1))
+        self.assertLess(centre.score, corner.score)
+
+    def test_pawn_structure(self):
+        def pawns(fen):
+            state = chessy.parse_FEN(fen)
+            return chessy.score_pawns(state.board, state.piece_squares, state.pawn_files)
+        self.assertEqual(pawns(chessy.STARTING_FEN), 0)
+        # Isolated and passed on the fifth rank
+        self.assertEqual(pawns("4k3/8/8/3P4/8/8/8/4K3 w - - 0 1"),
+                         chessy.PASSED_PAWN_BONUS[3] - chessy.PAWN_PUNISH)
+        # Doubled, isolated and passed, the front pawn blocking the other
+        self.assertEqual(pawns("4k3/8/8/3P4/3P4/8/8/4K3 w - - 0 1"),
+                         chessy.PASSED_PAWN_BONUS[3] + chessy.PASSED_PAWN_BONUS[2] 
+                         - 4 * chessy.PAWN_PUNISH - chessy.BLOCKED_PAWN_PUNISH)
+        # c4 and f6 passed, d3 backward since no pawn can defend it and e5 stops it
+        self.assertEqual(pawns("4k3/8/5p2/4p3/2P5/3P4/8/4K3 w - - 0 1"),
+                         chessy.PASSED_PAWN_BONUS[2] - chessy.PASSED_PAWN_BONUS[1] 
+                         - chessy.BACKWARD_PAWN_PUNISH)
+
+        chessy.pawn_table[:] = [None] * chessy.PAWN_TABLE_SIZE
+        state = chessy.parse_FEN("4k3/8/8/3P4/8/8/8/4K3 w - - 0 1")
+        self.assertEqual(chessy.pawn_structure(state), pawns(chessy.to_fen(state)))
+        # Only the pawns make the key, so a king move hits the same entry
+        moved = chessy.generate_new_state(state, *chessy.decode_move(chessy.uci_to_move(state, "e1f1")))
+        self.assertEqual(moved.pawn_zobrist, state.pawn_zobrist)
+        self.assertEqual(sum(entry is not None for entry in chessy.pawn_table), 1)
+
+    def test_vector_evaluation(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        states = []
+        for pos in positions:
+            if not pos["type"] == "perf_test": continue
+            state = chessy.parse_FEN(pos["fen"])
+            states += [state, *chessy.move_generation(state).values()]
+        expected = [chessy.static_evaluation(s) for s in states]
+        with unittest.mock.patch.object(vector_eval, "np", None):
+            self.assertEqual(vector_eval.evaluate_boards([s.board for s in states[:20]]), expected[:20])
+        np = vector_eval.np
+        if np is None:
+            self.skipTest("NumPy is not installed")
+        boards = np.array([s.board for s in states], np.uint8)
+        self.assertEqual(vector_eval.evaluate_boards(boards.view(np.int8)).tolist(), expected)
+        boards_64 = boards[:, chessy.SQUARES]
+        self.assertEqual(vector_eval.evaluate_boards(boards_64).tolist(), expected)
+
+    def test_count_moves(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        for pos in positions:
+            if not pos["type"] == "perf_test": continue
+            with self.subTest(pos=pos):
+                state = chessy.parse_FEN(pos["fen"])
+                for s in [state, *chessy.move_generation(state).values()]:
+                    other_side = s._replace(player=s.player ^ chessy.PLAYER_BITS)
+                    for side in (s, other_side):
+                        self.assertEqual(chessy.count_moves(side, chessy.enemy_attacks(side)),
+                                         len(chessy.move_generation(side)))
+
+    def test_encode_position(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        for pos in positions:
+            if not pos["type"] == "perf_test": continue
+            with self.subTest(pos=pos):
+                state = chessy.parse_FEN(pos["fen"])
+                states = [state, *chessy.move_generation(state).values()]
+                packed = b"".join(chessy.encode_position(s) for s in states)
+                self.assertEqual(len(packed), len(states) * chessy.POSITION_BYTES)
+                view = memoryview(packed)
+                for i, s in enumerate(states):
+                    decoded = chessy.decode_position(view, i * chessy.POSITION_BYTES)
+                    self.assertEqual(chessy.to_fen(decoded), chessy.to_fen(s))
+                    self.assertEqual(decoded.zobrist, s.zobrist)
+
+    def test_uci_moves(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        for pos in positions:
+            if not pos["type"] == "perf_test": continue
+            with self.subTest(pos=pos):
+                state = chessy.parse_FEN(pos["fen"])
+                for m in chessy.legal_moves(state):
+                    self.assertEqual(chessy.uci_to_move(state, chessy.move_to_uci(m)), m)
+                bb_state = bitboard.parse_FEN(pos["fen"])
+                self.assertCountEqual(map(bitboard.move_to_uci, bitboard.legal_moves(bb_state)),
+                                      map(chessy.move_to_uci, chessy.legal_moves(state)))
+                self.assertIsNone(chessy.uci_to_move(state, "a1a1"))
+
+    def test_transposition_table_replacement(self):
+        table = chessy.TranspositionTable(1)
+        deep, shallow, newest = (1 + i * table.num_buckets for i in range(3))
+        table.store(deep, 5, 10, chessy.EXACT, None)
+        table.store(shallow, 3, 20, chessy.LOWER_BOUND, None)
+        self.assertEqual(table.probe(deep)[1:4], (5, 10, chessy.EXACT))
+        self.assertEqual(table.probe(shallow)[1:4], (3, 20, chessy.LOWER_BOUND))
+        table.store(newest, 1, 30, chessy.UPPER_BOUND, None)
+        self.assertIsNotNone(table.probe(deep))
+        self.assertIsNone(table.probe(shallow))
+        self.assertEqual(table.probe(newest)[1:4], (1, 30, chessy.UPPER_BOUND))
+        table.new_search()
+        table.store(shallow, 3, 20, chessy.LOWER_BOUND, None)
+        self.assertIsNone(table.probe(deep))
+
+    def test_iterative_deepening_time_limit(self):
+        state = chessy.parse_FEN("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10")
+        board = [*state.board]
+        # A clock going 1ms forward per reading, so the deadline is checked
+        # 500 times, once per 64 nodes, whatever the speed of the machine
+        ticks = iter(range(10**9))
+        with unittest.mock.patch.object(chessy.time, "time", lambda: next(ticks) / 1000):
+            move, score = chessy.iterative_deepening(state, movetime=500)
+        self.assertLess(chessy.nodes, 501 * 64 + len(chessy.legal_moves(state)))
+        self.assertEqual(state.board, board)
+        self.assertEqual(state.piece_squares, chessy.parse_FEN(chessy.to_fen(state)).piece_squares)
+        self.assertIn(move, chessy.legal_moves(state))
+        self.assertIsNotNone(score)
+        self.assertEqual(chessy.time_budget(chessy.b, wtime=1000, btime=30_000, binc=400), 1.3)
+
+    def test_quiescence_search(self):
+        state = chessy.parse_FEN("4k3/8/2p5/3p4/8/8/8/3QK3 w - - 0 1")
+        options = chessy.search_options
+        try:
+            chessy.search_options = chessy.SearchOptions(quiescence=True)
+            chessy.transposition_table.clear()
+            res = chessy.search(state, 1)
+            self.assertNotEqual(res.captured_piece, chessy.bP)
+
+            mated = chessy.parse_FEN("R5k1/5ppp/8/8/8/1Q6/5PPP/6K1 b - - 0 1")
+            score = chessy.quiescence(mated, -chessy.ALPHABETA, chessy.ALPHABETA, chessy.enemy_attacks(mated))
+            self.assertEqual(score, -chessy.MATE)
+            chessy.transposition_table.clear()
+            res = chessy.search(chessy.parse_FEN("6k1/5ppp/8/8/8/1Q6/5PPP/R5K1 w - - 0 1"), 1)
+            self.assertIn(chessy.to_fen(res), ("R5k1/5ppp/8/8/8/1Q6/5PPP/6K1 b - - 1 1",
+                                               "1Q4k1/5ppp/8/8/8/8/5PPP/R5K1 b - - 1 1"))
+            # The back-rank problem 02 of test.json, a depth 6 tactic
+            chessy.transposition_table.clear()
+            res = chessy.search(chessy.parse_FEN("kb2R3/pr6/6p1/3Q1n2/2P5/1Pq2N2/K5P1/8 w - - 0 106"), 4)
+            self.assertEqual(chessy.to_fen(res), "kR6/pr6/6p1/3Q1n2/2P5/1Pq2N2/K5P1/8 b - - 0 106")
+        finally:
+            chessy.search_options = options
+            chessy.transposition_table.clear()
+
+    def test_aspiration_search(self):
+        state = chessy.parse_FEN("6k1/6p1/p2p3p/2pPb3/P1P1Pr2/6qP/4Q1P1/4RN1K b - - 0 1")
+        moves = chessy.root_moves(state)
+        chessy.transposition_table.clear()
+        move, score = chessy.search_root(state, 4, moves)
+        pv = chessy.principal_variation(state, 4)
+        self.assertEqual(pv[0], move)
+        self.assertEqual([chessy.move_to_uci(m) for m in pv[::2]], ["f4f1", "g3h2"])
+        for guess in (score - 1000, score + 1000, 0):
+            chessy.transposition_table.clear()
+            self.assertEqual(chessy.aspiration_search(state, 4, moves, guess), (move, score))
+        chessy.transposition_table.clear()
+
+    def test_parallel_search(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        options = chessy.search_options
+        try:
+            chessy.search_options = chessy.SearchOptions(workers=2)
+            for pos in positions:
+                if pos["type"] != "tactics_test" or pos["depth"] > 4: continue
+                depth = pos["depth"]
+                for f, r in zip(pos["fen"], pos["result"]):
+                    with self.subTest(f=f):
+                        res = chessy.search(chessy.parse_FEN(f), depth)
+                        self.assertEqual(chessy.to_fen(res), r)
+                    depth -= 2
+        finally:
+            chessy.search_options = options
+            chessy.transposition_table.clear()
+
+    def test_forward_pruning(self):
+        with open(__file__.replace(".py", ".json")) as f:
+            positions = json.load(f)
+        options = chessy.search_options
+        stats = {"null_move": "null move tries", "late_move_reductions": "reductions",
+                 "futility": "futility pruned"}
+        timed = {"null_move": "null move", "late_move_reductions": "reductions"}
+        try:
+            for option, stat in stats.items():
+                chessy.search_options = chessy.SearchOptions(**{option: True})
+                tried = 0
+                seconds = 0.0
+                for pos in positions:
+                    if pos["type"] != "tactics_test" or pos["depth"] > 4: continue
+                    depth = pos["depth"]
+                    for f, r in zip(pos["fen"], pos["result"]):
+                        with self.subTest(option=option, f=f):
+                            chessy.transposition_table.clear()
+                            res = chessy.search(chessy.parse_FEN(f), depth)
+                            self.assertEqual(chessy.to_fen(res), r)
+                            tried += chessy.search_stats[stat]
+                            seconds += chessy.search_times.get(timed.get(option, ""), 0)
+                        depth -= 2
+                self.assertGreater(tried, 0)
+                if option in timed:
+                    self.assertGreater(seconds, 0)
+        finally:
+            chessy.search_options = options
+            chessy.transposition_table.clear()
+        state = chessy.parse_FEN("4k3/4p3/8/8/8/8/4P3/4K3 w - - 0 1")
+        self.assertFalse(chessy.has_pieces(state))
+        passed = chessy.null_move(state)
+        self.assertEqual(passed.zobrist, chessy.zobrist_hash(passed))
+
+    def test_uci(self):
+        lines = []
+        engine = uci.UciEngine(lines.append)
+        try:
+            for command in ("uci", "setoption name Hash value 1", "isready",
+                            "position fen 6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1", "go depth 3"):
+                engine.handle(command)
+            engine.wait()
+            self.assertEqual(lines[-1], "bestmove a1a8")
+            self.assertIn("info depth 3 score mate 1", lines[-2])
+            self.assertEqual(chessy.transposition_table.num_buckets, 2**20 // (2 * chessy.TT_ENTRY_BYTES))
+
+            engine.handle("position startpos moves e2e4 e7e5")
+            engine.handle("go infinite")
+            time.sleep(0.2)
+            engine.handle("isready")
+            self.assertEqual(lines[-1], "readyok")
+            engine.handle("stop")
+            self.assertTrue(lines[-1].startswith("bestmove "))
+            self.assertIsNotNone(chessy.uci_to_move(engine.state, lines[-1].split()[1]))
+
+            engine.handle("position startpos")
+            engine.handle("go perft 2")
+            self.assertEqual(lines[-1], "Nodes searched: 400")
+            self.assertFalse(engine.handle("quit"))
+        finally:
+            chessy.transposition_table.resize(chessy.TT_SIZE_MB)
+
+    def test_uci_threads(self):
+        lines = []
+        engine = uci.UciEngine(lines.append)
+        options = chessy.search_options
+        try:
+            engine.handle("setoption name Threads value 2")
+            engine.handle("position startpos moves e2e4 e7e5")
+            engine.handle("go infinite")
+            time.sleep(0.5)
+            # The workers search on until they are told to stop
+            stopper = threading.Thread(target=engine.handle, args=("stop",), daemon=True)
+            stopper.start()
+            stopper.join(10)
+            self.assertFalse(stopper.is_alive())
+            self.assertTrue(lines[-1].startswith("bestmove "))
+            self.assertIsNotNone(chessy.uci_to_move(engine.state, lines[-1].split()[1]))
+        finally:
+            chessy.search_options = options
+            chessy.transposition_table.clear()
+
+    def test_batch(self):
+        lines = ['6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - bm Ra8#; id "back rank"; acd 2;\n',
+                 "\n", "# comment\n", chessy.STARTING_FEN + "\n", "not a position\n",
+                 "7k/8/8/8/8/8/8/K6q w - - 0 1\n", "8/8/8/8/8/8/8/8 w - - 0 1\n",
+                 "6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - acd x;\n"] * 3
+        try:
+            results = list(batch.analyse_lines(lines, 2, jobs=2))
+        finally:
+            chessy.transposition_table.clear()
+        self.assertEqual(len(results), 18)
+        for result in results:
+            result.pop("time", None)
+        self.assertEqual(results[:6], results[6:12])
+        mate, start, error, lost, no_kings, bad_depth = results[:6]
+        self.assertIn("error", no_kings)
+        self.assertIn("error", bad_depth)
+        self.assertEqual((mate["id"], mate["bestmove"], mate["mate"]), ("back rank", "a1a8", 1))
+        self.assertEqual(start["fen"], chessy.STARTING_FEN)
+        self.assertEqual(start["depth"], 2)
+        self.assertIn("error", error)
+        self.assertLess(lost["cp"], 0)
+
+    def test_opening_book(self):
+        pgn = ['[Event "1"]', "", "1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 1-0", "",
+               '[Event "2"]', "", "1. e4 c5 2. Nf3 {comment} d6 (2... Nc6 3. d4) 3. d4 cxd4",
+               "4. Nxd4 Nf6 5. Nc3 a6 6. Be2 e5 7. O-O $1 Be7 1/2-1/2", "",
+               '[FEN "4k3/1P6/8/8/8/8/8/4K3 w - - 0 1"]', "", "1. b8=Q+ Kd7 *"]
+        data = book.build_book(pgn, plies=14)
+        self.assertEqual(len(data), 21 * book.RECORD.size)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "book.bin")
+            with open(path, "wb") as f:
+                f.write(data)
+            opening_book = book.OpeningBook(path)
+            start = chessy.parse_FEN(chessy.STARTING_FEN)
+            self.assertEqual(opening_book.probe(start), [(chessy.uci_to_move(start, "e2e4"), 2)])
+            # The FEN leaves out the en passant square chessy sets after e4
+            e4 = chessy.parse_FEN("rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1")
+            moves = {chessy.move_to_uci(m): w for m, w in opening_book.probe(e4)}
+            self.assertEqual(moves, {"e7e5": 1, "c7c5": 1})
+            self.assertIn(chessy.move_to_uci(opening_book.choose(e4, random.Random(1))), moves)
+            castle = chessy.parse_FEN("rnbqkb1r/1p3ppp/p2p1n2/4p3/3NP3/2N5/PPP1BPPP/R1BQK2R w KQkq - 0 7")
+            self.assertEqual([chessy.move_to_uci(m) for m, _ in opening_book.probe(castle)], ["e1g1"])
+            promote = chessy.parse_FEN("4k3/1P6/8/8/8/8/8/4K3 w - - 0 1")
+            self.assertEqual([chessy.move_to_uci(m) for m, _ in opening_book.probe(promote)], ["b7b8q"])
+
+            lines = []
+            engine = uci.UciEngine(lines.append)
+            engine.handle(f"setoption name BookFile value {path}")
+            engine.handle("position startpos")
+            engine.handle("go wtime 1000 btime 1000")
+            self.assertEqual(lines, ["bestmove e2e4"])
+            engine.handle("setoption name BookFile value <empty>")
+            opening_book.close()
+            with open(path, "wb") as f:
+                pass
+            self.assertEqual(book.OpeningBook(path).probe(start), [])
+
+    def test_tablebase(self):
+        tables = tablebase.build(["KKQ"])
+        self.assertEqual(list(tables), ["KQK"])
+        self.assertEqual(max(tables["KQK"]) - 1, 20)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "tables.bin")
+            tablebase.write_tables(path, tables)
+            tb = tablebase.Tablebase(path)
+            mate_in_one = chessy.parse_FEN("7k/8/6K1/8/8/8/8/1Q6 w - - 0 1")
+            self.assertEqual(tb.probe(mate_in_one), 2)
+            self.assertEqual(tb.probe(chessy.parse_FEN("1Q5k/8/6K1/8/8/8/8/8 b - - 0 1")), 1)
+            # Black with the queen is probed with the colours swapped
+            self.assertEqual(tb.probe(chessy.parse_FEN("7K/8/6k1/8/8/8/8/1q6 b - - 0 1")), 2)
+            self.assertEqual(tb.probe(chessy.parse_FEN("k7/8/1K6/8/8/8/8/7B w - - 0 1")), 0)
+            self.assertIsNone(tb.probe(chessy.parse_FEN("k7/8/1K6/8/8/8/8/6RR w - - 0 1")))
+            self.assertEqual(tb.probe_score(mate_in_one), tablebase.TB_WIN - 2)
+
+            lines = []
+            engine = uci.UciEngine(lines.append)
+            engine.handle(f"setoption name TablebaseFile value {path}")
+            try:
+                state = chessy.parse_FEN("8/8/8/3k4/8/8/8/KQ6 w - - 0 1")
+                result = chessy.search(state, 2)
+                self.assertGreater(chessy.search_stats["tablebase hits"], 0)
+                self.assertEqual(tb.probe(result), tb.probe(state) - 1)
+            finally:
+                engine.handle("setoption name TablebaseFile value <empty>")
+            self.assertIsNone(chessy.endgame_tables)
+            tb.close()
+
     def test_tactics_4_moves_or_less(self):
         with open(__file__.replace(".py", ".json")) as f:
             positions = json.load(f)
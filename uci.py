@@ -0,0 +1,205 @@
+#!/bin/pypy3
+"""
+UCI front-end, keeps chessy running as one process with its transposition
+table warm between searches. Searches run on a thread so stop and isready
+are answered while the engine thinks.
+"""
+import sys
+import threading
+import time
+from typing import Callable, List, Optional
+
+import book
+import chessy
+import perft
+import tablebase
+
+ENGINE_NAME = "Chessy"
+MAX_HASH_MB = 4096
+MAX_THREADS = 64
+# Check options and the SearchOptions field each of them switches
+CHECK_OPTIONS = {"Quiescence": "quiescence", "NullMove": "null_move",
+                 "LateMoveReductions": "late_move_reductions", "Futility": "futility"}
+# go arguments followed by a number
+GO_LIMITS = ["depth", "movetime", "wtime", "btime", "winc", "binc",
+             "movestogo", "nodes", "perft"]
+
+
+def score_string(score: int, depth: int) -> str:
+    """
+    UCI score of a search to depth. A mate score is MATE times one more than
+    the depth left at the mated position, which gives the plies to the mate.
+    """
+    if abs(score) >= chessy.MATE:
+        moves = (depth - abs(score) // chessy.MATE + 2) // 2
+        return f"mate {moves if score > 0 else -moves}"
+    return f"cp {score}"
+
+
+class UciEngine:
+    """Handles UCI commands one line at a time, replies go to send"""
+    def __init__(self, send: Callable[[str], None]) -> None:
+        self.send = send
+        self.state = chessy.parse_FEN(chessy.STARTING_FEN)
+        self.search_thread: Optional[threading.Thread] = None
+        self.book: Optional[book.OpeningBook] = None
+
+    def handle(self, line: str) -> bool:
+        """Run one command, False once the engine is to quit"""
+        command, *args = line.split() or [""]
+        if command == "uci":
+            self.send(f"id name {ENGINE_NAME}")
+            self.send("id author chessy")
+            self.send(f"option name Hash type spin default {chessy.TT_SIZE_MB} "
+                      f"min 1 max {MAX_HASH_MB}")
+            self.send(f"option name Threads type spin default 1 min 1 max {MAX_THREADS}")
+            self.send("option name BookFile type string default <empty>")
+            self.send("option name TablebaseFile type string default <empty>")
+            for name, field in CHECK_OPTIONS.items():
+                default = str(getattr(chessy.SearchOptions(), field)).lower()
+                self.send(f"option name {name} type check default {default}")
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "ucinewgame":
+            self.stop()
+            chessy.transposition_table.clear()
+            chessy.clear_move_ordering()
+        elif command == "setoption":
+            self.stop()
+            self.set_option(args)
+        elif command == "position":
+            self.stop()
+            self.position(args)
+        elif command == "go":
+            self.stop()
+            self.go(args)
+        elif command == "stop":
+            self.stop()
+        elif command == "quit":
+            self.stop()
+            return False
+        elif command:
+            self.send(f"info string unknown command {command}")
+        return True
+
+    def set_option(self, args: List[str]) -> None:
+        if "name" not in args: return
+        start = args.index("name") + 1
+        end = args.index("value") if "value" in args else len(args)
+        name = " ".join(args[start:end])
+        value = " ".join(args[end + 1:])
+        if name == "Hash":
+            chessy.transposition_table.resize(max(1, min(int(value), MAX_HASH_MB)))
+        elif name == "BookFile":
+            if self.book is not None:
+                self.book.close()
+            self.book = None if value in ("", "<empty>") else book.OpeningBook(value)
+        elif name == "TablebaseFile":
+            if chessy.endgame_tables is not None:
+                chessy.endgame_tables.close()
+            chessy.endgame_tables = None if value in ("", "<empty>") else tablebase.Tablebase(value)
+        elif name == "Threads":
+            workers = max(1, min(int(value), MAX_THREADS))
+            chessy.search_options = chessy.search_options._replace(workers=workers)
+        elif name in CHECK_OPTIONS:
+            chessy.search_options = chessy.search_options._replace(
+                **{CHECK_OPTIONS[name]: value == "true"})
+        else:
+            self.send(f"info string unknown option {name}")
+
+    def position(self, args: List[str]) -> None:
+        moves = args.index("moves") if "moves" in args else len(args)
+        if args[:1] == ["startpos"]:
+            state = chessy.parse_FEN(chessy.STARTING_FEN)
+        elif args[:1] == ["fen"]:
+            state = chessy.parse_FEN(" ".join(args[1:moves]))
+        else:
+            return
+        for uci_move in args[moves + 1:]:
+            move = chessy.uci_to_move(state, uci_move)
+            if move is None:
+                self.send(f"info string illegal move {uci_move}")
+                break
+            state = chessy.generate_new_state(state, *chessy.decode_move(move))
+        self.state = state
+
+    def go(self, args: List[str]) -> None:
+        limits = {name: int(value) for name, value in zip(args, args[1:])
+                  if name in GO_LIMITS}
+        if "perft" in limits:
+            self.perft(limits["perft"])
+            return
+        # An infinite search is analysis, which waits for stop instead
+        if self.book is not None and "infinite" not in args:
+            move = self.book.choose(self.state)
+            if move is not None:
+                self.send(f"bestmove {chessy.move_to_uci(move)}")
+                return
+        chessy.stop_requested = False
+        self.search_thread = threading.Thread(
+            target=self.search, args=(self.state,), kwargs=limits, daemon=True)
+        self.search_thread.start()
+
+    def stop(self) -> None:
+        """Abort a running search and wait for it to send its bestmove"""
+        if self.search_thread is not None:
+            chessy.stop_requested = True
+            self.search_thread.join()
+            self.search_thread = None
+            chessy.stop_requested = False
+
+    def wait(self) -> None:
+        """Wait for a running search to finish by itself"""
+        if self.search_thread is not None:
+            self.search_thread.join()
+            self.search_thread = None
+
+    def search(self, state: chessy.GameState, depth: int = chessy.MAX_DEPTH,
+               nodes: Optional[int] = None, movetime: Optional[int] = None,
+               wtime: Optional[int] = None, btime: Optional[int] = None,
+               winc: int = 0, binc: int = 0, movestogo: Optional[int] = None) -> None:
+        start = time.time()
+
+        def report(depth: int, score: int, move: chessy.move_t) -> None:
+            elapsed = time.time() - start
+            pv = chessy.principal_variation(state, depth)
+            if pv[:1] != [move]:
+                pv = [move]
+            self.send(f"info depth {depth} score {score_string(score, depth)} "
+                      f"nodes {chessy.nodes} nps {int(chessy.nodes / max(elapsed, 0.001))} "
+                      f"time {int(elapsed * 1000)} pv {' '.join(map(chessy.move_to_uci, pv))}")
+
+        move, _ = chessy.iterative_deepening(
+            state, depth, movetime=movetime, wtime=wtime, btime=btime, winc=winc, binc=binc,
+            movestogo=movestogo, max_nodes=nodes, report=report)
+        self.send(f"bestmove {'0000' if move is None else chessy.move_to_uci(move)}")
+
+    def perft(self, depth: int) -> None:
+        """Leaf counts per root move, written like stockfish writes them"""
+        total = 0
+        for move, child in chessy.move_generation(self.state).items():
+            count = perft.num_moves(child, depth - 1)
+            total += count
+            self.send(f"{chessy.move_to_uci(move)}: {count}")
+        self.send("")
+        self.send(f"Nodes searched: {total}")
+
+
+output_lock = threading.Lock()
+def send(line: str) -> None:
+    with output_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+
+def main() -> None:
+    engine = UciEngine(send)
+    for line in sys.stdin:
+        if not engine.handle(line):
+            break
+    engine.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/bin/pypy3
+"""
+chessy.static_evaluation of many boards at once with NumPy, for bulk
+analysis and tuning. Boards are rows of chessy piece codes, 128 of them in
+the 0x88 layout or 64 from a8 to h1, as uint8 or as int8 holding the same
+bytes. NumPy is optional, without it the boards are evaluated one by one.
+
+The pawn terms work on one 64 bit integer per board and colour, bit i set
+for a pawn on square i from a8 = 0, so north is a right shift by 8.
+"""
+import sys
+import time
+from typing import List, Sequence
+
+import chessy
+from chessy import w, b, P
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore[assignment]
+
+# Boards evaluated per NumPy pass, bounding the temporary arrays
+CHUNK = 1 << 16
+
+
+def _board_128(board: Sequence[int]) -> List[int]:
+    if len(board) == 128:
+        return [piece & 0xff for piece in board]
+    board_128 = [0] * 128
+    for square, piece in zip(chessy.SQUARES, board):
+        board_128[square] = piece & 0xff
+    return board_128
+
+
+def evaluate_boards(boards):
+    """
+    chessy.static_evaluation of every board, from white's view, as an int64
+    array, or a list without NumPy
+    """
+    if np is None:
+        return [chessy.static_evaluation(chessy.game_state(
+                    _board_128(board), w, 0, chessy.OFF_THE_BOARD, 0, 1))
+                for board in boards]
+    boards = np.asarray(boards)
+    boards = boards.view(np.uint8) if boards.dtype == np.int8 else boards.astype(np.uint8, copy=False)
+    # Ranks of 8 squares, 0x88 boards have 8 off the board squares after each
+    ranks = boards.reshape(len(boards), 8, -1)[:, :, :8]
+    return np.concatenate([np.zeros(0, np.int64)] + [
+        _evaluate_chunk(ranks[i:i + CHUNK].reshape(-1, 64)) for i in range(0, len(boards), CHUNK)])
+
+
+if np is not None:
+    # Offset of each square of 64 into PACKED_VALUES, which is indexed by 
+    # square * 256 + piece code
+    SQUARE_OFFSETS = np.arange(0, 64 * 256, 256, dtype=np.int32)
+    _no_piece = chessy.PIECE_SQUARE_VALUE[0]
+    # The middlegame value, the endgame value and the phase of a piece on a 
+    # square packed into one int64, so one gather and one sum give all three. 
+    # The sums of 64 squares fit the fields
+    PHASE_BITS = 12
+    ENDGAME_BITS = 26
+    PACKED_VALUES = np.array([
+        (chessy.PIECE_SQUARE_VALUE.get(piece, _no_piece)[square] * (1 << ENDGAME_BITS)
+         + chessy.PIECE_SQUARE_VALUE_ENDGAME.get(piece, _no_piece)[square]) * (1 << PHASE_BITS)
+        + chessy.GAME_PHASE.get(piece, 0)
+        for square in chessy.SQUARES for piece in range(256)], np.int64)
+    # Weight of a doubled, isolated, blocked and backward pawn, white's then 
+    # black's, and the passed pawn bonus per rank from a8, 0 on the first and 
+    # last ranks
+    PAWN_WEIGHTS = np.array([sign * weight for sign in (1, -1) for weight in (
+        -chessy.PAWN_PUNISH, -chessy.PAWN_PUNISH, -chessy.BLOCKED_PAWN_PUNISH,
+        -chessy.BACKWARD_PAWN_PUNISH)], np.int64)
+    PASSED_BONUS = np.array([
+        sign * chessy.PASSED_PAWN_BONUS[6 - rank if c == w else rank - 1] if 0 < rank < 7 else 0
+        for c, sign in ((w, 1), (b, -1)) for rank in range(8)], np.int64)
+    # Bit masks of the byte wise population count
+    ODD_BITS = np.uint64(0x5555_5555_5555_5555)
+    BIT_PAIRS = np.uint64(0x3333_3333_3333_3333)
+    NIBBLES = np.uint64(0x0f0f_0f0f_0f0f_0f0f)
+    BYTES = np.uint64(0x0101_0101_0101_0101)
+
+    NOT_FILE_A = np.uint64(~sum(1 << i for i in range(0, 64, 8)) & (1 << 64) - 1)
+    NOT_FILE_H = np.uint64(~sum(1 << i for i in range(7, 64, 8)) & (1 << 64) - 1)
+
+
+def _evaluate_chunk(boards):
+    packed = PACKED_VALUES.take(boards + SQUARE_OFFSETS).sum(axis=1)
+    phase = np.minimum(packed & (1 << PHASE_BITS) - 1, chessy.MAX_PHASE)
+    # The endgame field is signed, the borrow a negative sum leaves in the 
+    # middlegame field is taken back with it
+    packed >>= PHASE_BITS
+    sign_bit = 1 << ENDGAME_BITS - 1
+    endgame = (packed + sign_bit & (1 << ENDGAME_BITS) - 1) - sign_bit
+    middlegame = (packed - endgame) >> ENDGAME_BITS
+    value = (middlegame * phase + endgame * (chessy.MAX_PHASE - phase)) // chessy.MAX_PHASE
+    return value + _pawn_scores(boards == P | w, boards == P | b)
+
+
+def _bitboards(squares):
+    packed = np.packbits(squares, axis=1, bitorder="little")
+    return np.ascontiguousarray(packed).view("<u8").ravel()
+
+
+def _rank_counts(bitboards):
+    """Bits set on each rank from a8, in the bytes of each bitboard"""
+    x = bitboards - (bitboards >> np.uint64(1) & ODD_BITS)
+    x = (x & BIT_PAIRS) + (x >> np.uint64(2) & BIT_PAIRS)
+    return (x + (x >> np.uint64(4))) & NIBBLES
+
+
+def _fill_north(x):
+    x = x | x >> np.uint64(8)
+    x = x | x >> np.uint64(16)
+    return x | x >> np.uint64(32)
+
+
+def _fill_south(x):
+    x = x | x << np.uint64(8)
+    x = x | x << np.uint64(16)
+    return x | x << np.uint64(32)
+
+
+def _sideways(x):
+    """x moved one file east and one file west"""
+    return (x << np.uint64(1)) & NOT_FILE_A | (x >> np.uint64(1)) & NOT_FILE_H
+
+
+def _pawn_scores(white, black):
+    """chessy.score_pawns of boolean white and black pawn squares"""
+    white, black = _bitboards(white), _bitboards(black)
+    eight = np.uint64(8)
+    white_attacks = (white >> np.uint64(9)) & NOT_FILE_H | (white >> np.uint64(7)) & NOT_FILE_A
+    black_attacks = (black << np.uint64(7)) & NOT_FILE_H | (black << np.uint64(9)) & NOT_FILE_A
+    # For each colour: the enemy pawns' front spans widened by a file, squares
+    # with an own pawn beside or in front on an adjacent file, and squares
+    # whose stop square an enemy pawn attacks
+    sides = ((white, (white | black) << eight, _fill_south(black << eight),
+              _sideways(_fill_north(white)), black_attacks << eight),
+             (black, (white | black) >> eight, _fill_north(white >> eight),
+              _sideways(_fill_south(black)), white_attacks >> eight))
+    counted, passed = [], []
+    for pawns, blockers, enemy_front, support, stop_attacked in sides:
+        # Every pawn of a file with more than one is doubled, and every pawn 
+        # of a file with none on the files beside it isolated
+        alone = pawns & ~(_fill_north(pawns >> eight) | _fill_south(pawns << eight))
+        isolated = pawns & ~_sideways(_fill_north(pawns) | _fill_south(pawns))
+        passed.append(pawns & ~(enemy_front | _sideways(enemy_front)))
+        backward = pawns & ~passed[-1] & ~support & stop_attacked
+        counted += [pawns ^ alone, isolated, pawns & blockers, backward]
+    # Only the passed pawn bonus depends on the rank, the rest is weighted by 
+    # the count, the sum of the bytes
+    counts = _rank_counts(np.stack(counted, axis=1)) * BYTES >> np.uint64(56)
+    passed_ranks = _rank_counts(np.stack(passed, axis=1)).astype("<u8", copy=False)
+    return (counts.view(np.int64) @ PAWN_WEIGHTS 
+            + passed_ranks.view(np.uint8).reshape(len(white), -1) @ PASSED_BONUS)
+
+
+if __name__ == "__main__":
+    if np is None:
+        sys.exit("the benchmark needs NumPy")
+    rng = np.random.default_rng(0)
+    states = [chessy.parse_FEN(chessy.STARTING_FEN)]
+    while len(states) < 1000:
+        children = list(chessy.move_generation(states[-1]).values())
+        states.append(children[rng.integers(len(children))] if children
+                      else chessy.parse_FEN(chessy.STARTING_FEN))
+    boards = np.array([s.board for s in states], np.uint8)[rng.integers(len(states), size=1_000_000)]
+    start = time.time()
+    evaluate_boards(boards)
+    print(f"{len(boards)} boards in {time.time() - start:.2f}s")